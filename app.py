@@ -1,25 +1,28 @@
+import time
+# Startup time per step, reported when the app is ready
+startup_times = [("start", time.time())]
 import database_scripts as db
 import plot_builder as pltbld
 from dash import Dash, html, dcc, ctx, dash_table
-import plotly.express as px
-import pandas as pd
 import dash_bootstrap_components as dbc
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output, State, ClientsideFunction
+# Not deferred: the layout below is built at import and uses daq.BooleanSwitch (dev_generate_map)
 import dash_daq as daq
-import time
 from dash.exceptions import PreventUpdate
-
-
-import numpy as np
+startup_times.append(("imports", time.time()))
 
 # Theme: https://bootswatch.com/flatly/
 
 """
 Connect to SQLite3 database
 """
-conn = db.connect_sqlite3("cites")
+# Callbacks take a read-only connection from the pool of the worker (db.read_connection)
+database = "cites"
 dev = False
 dev_year = 2022
+# Load the species search index on the first search instead of at startup
+lazy_startup = True
+startup_times.append(("database", time.time()))
 
 # db.build_species_plus_table("cites")
 
@@ -56,7 +59,9 @@ null_graph = {
 """
 Layout Components
 """
-dropdown_dict = db.build_dropdown_species()
+if not lazy_startup:
+    db.get_species_search_index(database)
+    startup_times.append(("species index", time.time()))
 # Store shipments for fast filtering
 
 
@@ -71,9 +76,8 @@ header = html.Div(
         # Papio hamadryas
         # Agapornis roseicollis
         html.Div(id="search_hidden_div", style={"display": "none"}),
-        html.Div(id="trashcan_1", style={"display": "none"}),
-        html.Div(id="trashcan_2", style={"display": "none"}),
         dcc.Store(id="shipment_Store"),
+        dcc.Store(id="shipment_key_Store"),
         dcc.Store(id="map_fig_no_traces_Store")
 
     ]
@@ -202,7 +206,11 @@ temporal_control = dbc.Card(
                                                          }, debounce=True),
                                         dbc.Button("+", outline=True, color="secondary", className="me-1",
                                                    id="temporal_plus"),
+                                        dbc.Button(html.I(className="bi bi-play-fill"), outline=True,
+                                                   color="secondary", className="me-1", id="temporal_play"),
                                     ]),
+                                # Steps the year while playing
+                                dcc.Interval(id="temporal_play_interval", interval=1000, disabled=True),
                             ], md=7
                         )
                     ]
@@ -316,6 +324,7 @@ app.layout = dbc.Container(
     ],
     fluid=True, style={"backgroundColor": "#eeeeee", "margin-bottom":"20px"}
 )
+startup_times.append(("layout", time.time()))
 
 """
 Search Callback
@@ -327,9 +336,9 @@ Search Callback
 def update_options(search_value):
     if not search_value:
         raise PreventUpdate
-    if len(search_value) < 5:
+    if len(search_value) < 3:
         raise PreventUpdate
-    return [o for o in dropdown_dict if search_value in o["label"]]
+    return db.search_species(db.get_species_search_index(database), search_value)
 
 @app.callback(
     Output("search_hidden_div", "children"),
@@ -342,15 +351,14 @@ def update_options(search_value):
     Input("input_taxon", "value"), prevent_initial_call=True
 )
 def create_taxon_temp_table(input_taxon):
-    db.build_main_df(input_taxon, conn, ctx.triggered_id)
-    sql = "SELECT MIN(Year), MAX(Year), Family FROM temp.Taxon"
-    basic_data = db.run_query(sql, conn)
-    temporal_min = int(basic_data["MIN(Year)"].values[0])
-    temporal_max = int(basic_data["MAX(Year)"].values[0])
-    family = str(basic_data["Family"].values[0])
-    kingdom = ".."
-    history_listing_table = pltbld.history_listing_generator(input_taxon, conn)
-    return "search_active", temporal_min, temporal_max, kingdom, family, history_listing_table, 0
+    with db.read_connection(database) as conn:
+        taxon_data = db.build_main_df(input_taxon, conn, ctx.triggered_id)
+        temporal_min = int(taxon_data["Year"].min())
+        temporal_max = int(taxon_data["Year"].max())
+        family = str(db.get_taxon_family(input_taxon, conn))
+        kingdom = ".."
+        history_listing_table = pltbld.get_history_listing(input_taxon, conn)
+        return "search_active", temporal_min, temporal_max, kingdom, family, history_listing_table, 0
 
 
 """
@@ -364,9 +372,12 @@ Temporal Callbacks
     Input("temporal_input", "value"),
     Input("temporal_start", "children"),
     Input("temporal_plus", "n_clicks"),
-    Input("temporal_minus", "n_clicks"), prevent_initial_call=True
+    Input("temporal_minus", "n_clicks"),
+    Input("temporal_play", "n_clicks"),
+    Input("temporal_play_interval", "n_intervals"), prevent_initial_call=True
 )
-def temporal_buttons(temporal_max, temporal_input, temporal_start, temporal_plus, temporal_minus):
+def temporal_buttons(temporal_max, temporal_input, temporal_start, temporal_plus, temporal_minus, temporal_play,
+                     temporal_play_interval):
     if dev:
         return dev_year
     if ctx.triggered_id == "temporal_input":
@@ -375,10 +386,42 @@ def temporal_buttons(temporal_max, temporal_input, temporal_start, temporal_plus
         return int(temporal_input) + 1
     elif ctx.triggered_id == "temporal_minus":
         return int(temporal_input) - 1
+    elif ctx.triggered_id == "temporal_play_interval":
+        return min(int(temporal_input) + 1, int(temporal_max))
+    elif ctx.triggered_id == "temporal_play":
+        # Play from the first year if the last year is shown
+        if int(temporal_input) >= int(temporal_max):
+            return int(temporal_start)
+        raise PreventUpdate
     else:
         return temporal_max # temporal_start + 10
 
 
+"""
+Play the years (timeline)
+The map serves every year from the connection timeline of the taxon, see plot_builder.
+"""
+
+
+@app.callback(
+    Output("temporal_play_interval", "disabled"),
+    Output("temporal_play", "children"),
+    Input("temporal_play", "n_clicks"),
+    Input("temporal_input", "value"),
+    State("temporal_max", "children"),
+    State("temporal_play_interval", "disabled"), prevent_initial_call=True
+)
+def temporal_playback(temporal_play, temporal_input, temporal_max, temporal_play_interval_disabled):
+    if ctx.triggered_id == "temporal_play":
+        playing = temporal_play_interval_disabled
+    elif not temporal_play_interval_disabled and int(temporal_input) >= int(temporal_max):
+        # Stop at the last year
+        playing = False
+    else:
+        raise PreventUpdate
+    return not playing, html.I(className="bi bi-pause-fill" if playing else "bi bi-play-fill")
+
+
 """
 Filter Callbacks
 """
@@ -391,117 +434,112 @@ Filter Callbacks
     Output("filter_purpose", "value"),
     Output("filter_source", "options"),
     Output("filter_source", "value"),
-    Input("search_hidden_div", "children"), prevent_initial_call=True)
-def populate_filters(activation):
-    Term_List = db.get_unique_values("Term", conn)
-    Purpose_List = db.get_unique_values("Purpose", conn)
-    Purpose_List.sort()
-    Purpose_Dict = pltbld.create_filters_dict(Purpose_List, "Purpose")
-    Source_List = db.get_unique_values("Source", conn)
-    Source_List.sort()
-    Source_Dict = pltbld.create_filters_dict(Source_List, "Source")
-    return Term_List, Term_List, Purpose_Dict, Purpose_List, Source_Dict, Source_List
+    Input("search_hidden_div", "children"),
+    State("input_taxon", "value"), prevent_initial_call=True)
+def populate_filters(activation, input_taxon):
+    with db.read_connection(database) as conn:
+        Term_List = db.get_unique_values(input_taxon, "Term", conn)
+        Purpose_List = db.get_unique_values(input_taxon, "Purpose", conn)
+        Purpose_List.sort()
+        Purpose_Dict = pltbld.create_filters_dict(Purpose_List, "Purpose")
+        Source_List = db.get_unique_values(input_taxon, "Source", conn)
+        Source_List.sort()
+        Source_Dict = pltbld.create_filters_dict(Source_List, "Source")
+        return Term_List, Term_List, Purpose_Dict, Purpose_List, Source_Dict, Source_List
 
 
 """
-Term Type per Trade Callback
+Line Diagram Callback (Term type per trade, Source and Purpose)
 """
 
 
 @app.callback(
     Output("plot_1_graph", "figure"),
     Output("total_shipments", "children"),
-    Input("search_hidden_div", "children"),
-    Input("temporal_input", "value"),
-    Input("filter_terms", "value"),
-    Input("filter_purpose", "value"),
-    Input("filter_source", "value"), prevent_initial_call=True
-)
-def build_plot1(activation, temporal_input, filter_terms, filter_purpose, filter_source):
-    plot = pltbld.build_line_diagram("Term", temporal_input, filter_terms, filter_purpose, filter_source, conn)
-    return plot
-
-
-"""
-Source Plot Callback
-"""
-
-
-@app.callback(
     Output("plot_2a_graph", "figure"),
-    Output("trashcan_1", "children"),
+    Output("plot_purpose", "figure"),
     Input("search_hidden_div", "children"),
     Input("temporal_input", "value"),
     Input("filter_terms", "value"),
     Input("filter_purpose", "value"),
-    Input("filter_source", "value"), prevent_initial_call=True
+    Input("filter_source", "value"),
+    State("input_taxon", "value"), prevent_initial_call=True
 )
-def build_plot2a(activation, temporal_input, filter_terms, filter_purpose, filter_source):
-    plot = pltbld.build_line_diagram("Source", temporal_input, filter_terms, filter_purpose, filter_source, conn)
-    return plot
+def build_line_plots(activation, temporal_input, filter_terms, filter_purpose, filter_source, input_taxon):
+    with db.read_connection(database) as conn:
+        plots = pltbld.get_line_diagrams(input_taxon, temporal_input, filter_terms, filter_purpose, filter_source,
+                                         conn)
+        return plots
 
 
 """
-Purpose Plot Callback
+Spatial Callback
 """
 
 
 @app.callback(
-    Output("plot_purpose", "figure"),
-    Output("trashcan_2", "children"),
+    Output("map_fig_no_traces_Store", "data"),
     Input("search_hidden_div", "children"),
-    Input("temporal_input", "value"),
-    Input("filter_terms", "value"),
-    Input("filter_purpose", "value"),
-    Input("filter_source", "value"), prevent_initial_call=True
-)
-def build_plot2b(activation, temporal_input, filter_terms, filter_purpose, filter_source):
-    plot = pltbld.build_line_diagram("Purpose", temporal_input, filter_terms, filter_purpose, filter_source, conn)
-    return plot
-
-
-"""
-Spatial Callback
-"""
+    Input("dev_generate_map", "on"),
+    State("input_taxon", "value"), prevent_initial_call=True)
+def build_map_layers(activation, dev_generate_map, input_taxon):
+    with db.read_connection(database) as conn:
+        # Base map and distribution layer only change with the taxon
+        map_fig_no_traces = pltbld.get_base_map_graph()
+        if dev_generate_map:
+            map_fig_no_traces = pltbld.add_distributions_to_map_graph(input_taxon, conn, map_fig_no_traces)
+        return map_fig_no_traces
 
 
 @app.callback(
-    Output("spatial_map", "figure"),
     Output("shipment_Store", "data"),
+    Output("shipment_key_Store", "data"),
     Input("search_hidden_div", "children"),
-    Input("input_taxon", "value"),
     Input("temporal_input", "value"),
     Input("filter_terms", "value"),
     Input("filter_purpose", "value"),
     Input("filter_source", "value"),
-    Input("map_shipments_lower_tol", "value"),
-    Input("shipment_Store", "data"),
-    Input("dev_generate_map", "on"), prevent_initial_call=True)
-def build_map(activation, input_taxon, temporal_input, filter_terms, filter_purpose, filter_source,
-              map_shipments_lower_tol, shipment_Store, dev_generate_map):
-
-    if dev_generate_map:
-        start = time.time()
-        if ctx.triggered_id == "map_shipments_lower_tol":
-            print("Updating map with lower tolerance...")
-            map_fig_no_traces = pltbld.build_empty_map_graph()
-            map_fig_no_traces = pltbld.add_distributions_to_map_graph(input_taxon, conn, map_fig_no_traces)
-            shipment_Store_read = pd.read_json(shipment_Store, orient="split")
-            map_fig = pltbld.map_tolerance_update(map_fig_no_traces, shipment_Store_read, map_shipments_lower_tol)
-            return map_fig, shipment_Store
+    Input("dev_generate_map", "on"),
+    State("input_taxon", "value"),
+    State("shipment_key_Store", "data"), prevent_initial_call=True)
+def build_map(activation, temporal_input, filter_terms, filter_purpose, filter_source, dev_generate_map,
+              input_taxon, shipment_key_Store):
+    with db.read_connection(database) as conn:
+        if dev_generate_map:
+            start = time.time()
+            # The store holds the connections of a taxon and filters, the year only changes the counts
+            shipment_key = {"taxon": input_taxon, "terms": filter_terms, "purpose": filter_purpose,
+                            "source": filter_source, "year": temporal_input}
+            previous_key = dict(shipment_key_Store or {}, year=temporal_input)
+            if ctx.triggered_id == "temporal_input" and previous_key == shipment_key:
+                print("Updating map year ...")
+                shipment_Store = pltbld.connection_store_patch(input_taxon, shipment_key_Store["year"],
+                                                               temporal_input, filter_terms, filter_purpose,
+                                                               filter_source, conn)
+            else:
+                print("Building map ...")
+                # Connections are drawn and filtered by the lower tolerance in the browser
+                shipment_Store = pltbld.get_connection_store_data(input_taxon, temporal_input, filter_terms,
+                                                                  filter_purpose, filter_source, conn)
+            end = time.time()
+            elapsed_time = round(end - start, 0)
+            print(f"Finished map! Elapsed Process Time: {elapsed_time} secs")
+            return shipment_Store, shipment_key
         else:
-            print("Building map ...")
-            map_fig_no_traces = pltbld.build_empty_map_graph()
-            map_fig_no_traces = pltbld.add_distributions_to_map_graph(input_taxon, conn, map_fig_no_traces)
-            map_fig, shipment_traces = pltbld.update_map_graph(temporal_input, filter_terms, filter_purpose, filter_source, conn,
-                                             map_shipments_lower_tol, map_fig_no_traces)
-        end = time.time()
-        elapsed_time = round(end - start, 0)
-        print(f"Finished map! Elapsed Process Time: {elapsed_time} secs")
-        return map_fig, shipment_traces.to_json(date_format="iso", orient="split")
-    else:
-        map_fig_no_traces = pltbld.build_empty_map_graph()
-        return map_fig_no_traces, shipment_Store
+            return None, None
+
+
+app.clientside_callback(
+    ClientsideFunction(namespace="map", function_name="draw_connections"),
+    Output("spatial_map", "figure"),
+    Input("map_fig_no_traces_Store", "data"),
+    Input("shipment_Store", "data"),
+    Input("map_shipments_lower_tol", "value"), prevent_initial_call=True)
+
+startup_times.append(("callbacks", time.time()))
+print("Startup: " + ", ".join(f"{step} {end - begin:.2f} s" for (_, begin), (step, end) in
+                              zip(startup_times, startup_times[1:])) +
+      f" (total {startup_times[-1][1] - startup_times[0][1]:.2f} s)")
 
 
 if __name__ == "__main__":
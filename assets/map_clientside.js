@@ -0,0 +1,128 @@
+/*
+Map connections drawn in the browser
+The server sends the map without connections (map_fig_no_traces_Store) and the connections
+(shipment_Store). Moving the lower tolerance slider only filters the connections here,
+so it does not cause any server work.
+The store is packed by connection_store_data in plot_builder.py, which also calculates the opacity.
+The width is calculated here from the counts.
+*/
+
+function unpack_column(packed, ArrayType) {
+    const binary = atob(packed);
+    const bytes = new Uint8Array(binary.length);
+    for (let i = 0; i < binary.length; i++) {
+        bytes[i] = binary.charCodeAt(i);
+    }
+    return new ArrayType(bytes.buffer);
+}
+
+function unpack_connections(shipment_Store) {
+    return {
+        country_name: shipment_Store.countries.name,
+        country_latitude: unpack_column(shipment_Store.countries.latitude, Float32Array),
+        country_longitude: unpack_column(shipment_Store.countries.longitude, Float32Array),
+        exporter: unpack_column(shipment_Store.exporter, Uint16Array),
+        importer: unpack_column(shipment_Store.importer, Uint16Array),
+        mid_latitude: unpack_column(shipment_Store.mid_latitude, Float32Array),
+        mid_longitude: unpack_column(shipment_Store.mid_longitude, Float32Array),
+        count: shipment_Store.count,
+        last_shipment: shipment_Store.last_shipment,
+        opacity: shipment_Store.opacity
+    };
+}
+
+// Width between 1 and 10, scaled from the smallest to the largest count of the traded connections
+function connection_width(store) {
+    const traded = store.count.filter(function (count) { return count > 0; });
+    const count_max = Math.max.apply(null, traded);
+    const count_min = Math.min.apply(null, traded);
+    return store.count.map(function (count) {
+        if (count_max === count_min) {
+            return 1;
+        }
+        const width = Math.round(((count - count_min) / (count_max - count_min)) * 10 * 100) / 100;
+        return Math.min(10, Math.max(1, width));
+    });
+}
+
+function connection_description(store, i) {
+    return "<b>Exporter</b>: " + store.country_name[store.exporter[i]] + "<br>" +
+        "<b>Importer</b>: " + store.country_name[store.importer[i]] + "<br>" +
+        "——————————" + "<br>" +
+        "<b># Trades</b>: " + store.count[i] + "<br>" +
+        "<b>Last Trade</b>: " + store.last_shipment[i];
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    map: {
+        draw_connections: function (map_fig_no_traces, shipment_Store, map_shipments_lower_tol) {
+            if (!map_fig_no_traces) {
+                return window.dash_clientside.no_update;
+            }
+            if (!shipment_Store) {
+                return map_fig_no_traces;
+            }
+            const store = unpack_connections(shipment_Store);
+            store.width = connection_width(store);
+            const tol = map_shipments_lower_tol || 0;
+            const connections = [];
+            for (let i = 0; i < shipment_Store.rows; i++) {
+                if (store.count[i] > tol) {
+                    connections.push(i);
+                }
+            }
+            // Connections with the same opacity and (rounded) width are drawn as one trace
+            const buckets = new Map();
+            connections.forEach(function (i) {
+                const opacity = Math.round(store.opacity[i] * 100) / 100;
+                const width = Math.min(10, Math.max(1, Math.round(store.width[i])));
+                const key = opacity + "|" + width;
+                if (!buckets.has(key)) {
+                    buckets.set(key, {opacity: opacity, width: width, lat: [], lon: []});
+                }
+                const bucket = buckets.get(key);
+                bucket.lat.push(store.country_latitude[store.exporter[i]], store.mid_latitude[i],
+                    store.country_latitude[store.importer[i]], null);
+                bucket.lon.push(store.country_longitude[store.exporter[i]], store.mid_longitude[i],
+                    store.country_longitude[store.importer[i]], null);
+            });
+            const styles = Array.from(buckets.values()).sort(function (a, b) {
+                return (a.opacity - b.opacity) || (a.width - b.width);
+            });
+            const traces = styles.map(function (bucket) {
+                return {
+                    type: "scattergeo",
+                    lat: bucket.lat,
+                    lon: bucket.lon,
+                    mode: "lines",
+                    hoverinfo: "skip",
+                    line: {width: bucket.width, color: "rgba(31, 120, 180, " + bucket.opacity + ")"}
+                };
+            });
+            // Info Dot
+            traces.push({
+                type: "scattergeo",
+                lat: connections.map(function (i) { return store.mid_latitude[i]; }),
+                lon: connections.map(function (i) { return store.mid_longitude[i]; }),
+                text: connections.map(function (i) { return connection_description(store, i); }),
+                mode: "markers",
+                hoverinfo: "text",
+                marker: {
+                    size: 12,
+                    symbol: "circle",
+                    opacity: connections.map(function (i) { return store.opacity[i]; }),
+                    cauto: false,
+                    color: "#12476b",
+                    line: {width: 2, color: "#1f78b4"}
+                },
+                hoverlabel: {
+                    bgcolor: "#6695b4",
+                    bordercolor: "#1f78b4",
+                    font: {color: "black", size: 12, family: "Verdana"},
+                    align: "left"
+                }
+            });
+            return {data: map_fig_no_traces.data.concat(traces), layout: map_fig_no_traces.layout};
+        }
+    }
+});
@@ -1,4 +1,5 @@
-import sql
+import database_scripts as db
 
-
-sql.build_database("cites")
\ No newline at end of file
+if __name__ == "__main__":
+    # The guard is needed for the worker processes of the csv import
+    db.build_database("cites")
@@ -0,0 +1,130 @@
+import functools
+import json
+import os
+import pandas as pd
+
+"""
+Country registry (alpha-2 -> name, alpha-3, latitude, longitude)
+Loaded once from the bundled centroid file. Historic ISO codes used in the trade database
+are resolved to their successor at load time, codes without a location are left out.
+"""
+historic_ISO_dict = {"AN": "BQ",
+                     "CS": "RS",
+                     "DD": "DE",
+                     "NT": "IQ",
+                     "PC": "FM",
+                     "XA": "Unknown",
+                     "XC": "Unknown",
+                     "XE": "Unknown",
+                     "XF": "Unknown",
+                     "XM": "Unknown",
+                     "XS": "Unknown",
+                     "YU": "HR",
+                     "ZC": "Unknown",
+                     "ZZ": "Unknown",
+                     }
+
+
+def load_country_registry():
+    json_file = os.path.join(os.path.dirname(__file__), "data", "country-codes-lat-long-alpha3.json")
+    with open(json_file, "r", encoding="utf-8") as f:
+        countries_json = json.load(f)
+    registry = pd.DataFrame(countries_json["ref_country_codes"])
+    registry = registry[["alpha2", "alpha3", "country", "latitude", "longitude"]].set_index("alpha2")
+    historic = pd.Series(historic_ISO_dict)
+    historic = historic[historic.isin(registry.index)]
+    historic_registry = registry.loc[historic.values].set_index(historic.index)
+    registry = pd.concat([registry, historic_registry[~historic_registry.index.isin(registry.index)]])
+    registry.index.name = "alpha2"
+    return registry
+
+
+country_registry = load_country_registry()
+
+
+"""
+Country code translation (name, alpha_2, alpha_3)
+Exact names and codes are looked up in an index built from pycountry on first use.
+Values without an exact match (e.g. "Congo (Democratic Republic of the)") fall back
+to a memoized scan of pycountry.
+"""
+
+
+def build_countrycode_index():
+    import pycountry
+    index = {"name": {}, "alpha_2": {}, "alpha_3": {}}
+    # Current countries take precedence over historic countries
+    for co in list(pycountry.countries):
+        for attribute in ["name", "official_name", "common_name"]:
+            if hasattr(co, attribute):
+                index["name"].setdefault(getattr(co, attribute), co)
+        index["alpha_2"].setdefault(co.alpha_2, co)
+        index["alpha_3"].setdefault(co.alpha_3, co)
+    for co in list(pycountry.historic_countries):
+        index["name"].setdefault(co.name, co)
+        index["alpha_2"].setdefault(co.alpha_2, co)
+        index["alpha_3"].setdefault(co.alpha_3, co)
+    return index
+
+
+countrycode_index = None
+
+
+def convert_countrycode(value, input_type, output_type):
+    global countrycode_index
+    if countrycode_index is None:
+        countrycode_index = build_countrycode_index()
+    co = countrycode_index[input_type].get(value)
+    if co is not None:
+        return getattr(co, output_type)
+    return convert_countrycode_fuzzy(value, input_type, output_type)
+
+
+@functools.lru_cache(maxsize=None)
+def convert_countrycode_fuzzy(value, input_type, output_type):
+    import pycountry
+
+    def result(co, output_type):
+        if output_type == "name":
+            return co.name
+        if output_type == "alpha_2":
+            return co.alpha_2
+        if output_type == "alpha_3":
+            return co.alpha_3
+
+    for co in list(pycountry.countries):
+        if input_type == "name":
+            if value in co.name:
+                return result(co, output_type)
+            try:
+                if value in co.official_name:
+                    return result(co, output_type)
+            except:
+                pass
+            value_alt = value.replace(" (", ", ")
+            value_alt = value_alt.replace(")", "")
+            if value_alt in co.name:
+                return result(co, output_type)
+        if input_type == "alpha_2":
+            if value in co.alpha_2:
+                return result(co, output_type)
+        if input_type == "alpha_3":
+            if value in co.alpha_3:
+                return result(co, output_type)
+    for co in list(pycountry.historic_countries):
+        if input_type == "name":
+            if value in co.name:
+                return result(co, output_type)
+        if input_type == "alpha_2":
+            if value in co.alpha_2:
+                return result(co, output_type)
+        if input_type == "alpha_3":
+            if value in co.alpha_3:
+                return result(co, output_type)
+    return value + "(Not Found)"
+
+
+def convert_countrycode_column(column, input_type, output_type):
+    # Translate every distinct value once and map the result onto the whole column
+    translation = {value: convert_countrycode(value, input_type, output_type) for value in column.unique()}
+    return column.map(translation)
@@ -1,11 +1,21 @@
+import contextlib
 import csv
 import datetime
+import hashlib
+import multiprocessing
 import os
+import pickle
 import sqlite3
+import threading
 import time
+import urllib.parse
+import uuid
+from collections import OrderedDict
+from queue import Empty, Full, LifoQueue
 import pandas as pd
 import numpy as np
-import pycountry
+import query_builder as qb
+import country_codes as cc
 
 """
 Connect to database
@@ -15,12 +25,70 @@ Connect to database
 def connect_sqlite3(database):
     connection = None
     try:
-        connection = sqlite3.connect(database + ".db", check_same_thread=False)
+        connection = sqlite3.connect(database + ".db", check_same_thread=False, cached_statements=256)
     except sqlite3.Error as err:
         print(f"The error '{err}' occurred during 'connection to database' in connect_sqlite3")
     return connection
 
 
+"""
+Read-only connections for the dashboard
+Callbacks take a read-only connection from a small pool (read_connection), so callbacks running in
+parallel do not share (and serialize on) one connection, and threads of the threaded dev server do
+not open a connection each. At most read_connection_pool_size idle connections are kept per
+database, connections opened beyond that are closed after use.
+The dashboard only reads the database; all per-user state lives in the browser (dcc.Store), and
+the server caches hold read-only data. The database is opened with mode=ro and not as immutable,
+since it can be rebuilt while the dashboard runs (see get_database_build_id).
+"""
+
+read_connection_pool_size = 8
+read_connection_pools = {}
+read_connection_pools_lock = threading.Lock()
+read_connection_pools_pid = None
+
+
+def connect_sqlite3_readonly(database):
+    connection = None
+    try:
+        uri = "file:{0}?mode=ro".format(urllib.parse.quote(os.path.abspath(database + ".db")))
+        # A pooled connection is used by one thread at a time, but not always the same thread
+        connection = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=256)
+        connection.execute("PRAGMA query_only = ON")
+    except sqlite3.Error as err:
+        print(f"The error '{err}' occurred during 'connection to database' in connect_sqlite3_readonly")
+    return connection
+
+
+def get_read_connection_pool(database):
+    global read_connection_pools_pid
+    with read_connection_pools_lock:
+        # Connections are not shared with forked worker processes
+        if read_connection_pools_pid != os.getpid():
+            read_connection_pools_pid = os.getpid()
+            read_connection_pools.clear()
+        if database not in read_connection_pools:
+            read_connection_pools[database] = LifoQueue(maxsize=read_connection_pool_size)
+        return read_connection_pools[database]
+
+
+@contextlib.contextmanager
+def read_connection(database):
+    pool = get_read_connection_pool(database)
+    try:
+        conn = pool.get_nowait()
+    except Empty:
+        conn = connect_sqlite3_readonly(database)
+    try:
+        yield conn
+    finally:
+        if conn is not None:
+            try:
+                pool.put_nowait(conn)
+            except Full:
+                conn.close()
+
+
 """
 Drop Table if already exists
 """
@@ -36,6 +104,39 @@ def drop_table_if_exist(conn, table):
         print(f"The error '{err}' occurred during 'drop table' in drop_table_if_exist")
 
 
+"""
+Check if Table exists
+"""
+
+
+def table_exists(conn, table):
+    sql = "SELECT name FROM sqlite_master WHERE type='table' AND name=?"
+    return conn.execute(sql, (table,)).fetchone() is not None
+
+
+"""
+Database build id
+Every build of the database (shipments, Species+ or history listings) stores a new build id.
+Caches of data derived from the database are dropped when the build id changes.
+"""
+
+
+def mark_database_build(conn):
+    try:
+        conn.execute("CREATE TABLE IF NOT EXISTS build_info (key TEXT PRIMARY KEY, value TEXT)")
+        conn.execute("INSERT OR REPLACE INTO build_info (key, value) VALUES ('build_id', ?)", (uuid.uuid4().hex,))
+        conn.commit()
+    except sqlite3.Error as err:
+        print(f"The error '{err}' occurred while marking the database build")
+
+
+def get_database_build_id(conn):
+    if not table_exists(conn, "build_info"):
+        return None
+    row = conn.execute("SELECT value FROM build_info WHERE key='build_id'").fetchone()
+    return row[0] if row else None
+
+
 """
 Create Table
 """
@@ -58,9 +159,9 @@ Run query on database and return as pandas df
 """
 
 
-def run_query(sql, conn):
+def run_query(sql, conn, params=None):
     try:
-        result = pd.read_sql_query(sql, conn)
+        result = pd.read_sql_query(sql, conn, params=params)
     except sqlite3.Error as err:
         print(f"The error '{err}' occurred during run_query")
     return result
@@ -71,10 +172,13 @@ Populate Dropdown Menu (Species)
 """
 
 
-def build_dropdown_species():
+def build_dropdown_species(database):
     try:
-        conn = connect_sqlite3("cites")
-        df = run_query("SELECT Taxon, amount FROM distinct_table_amount", conn)
+        conn = connect_sqlite3_readonly(database)
+        sql, params = qb.select("distinct_table_amount", ["Taxon", "amount"])
+        df = run_query(sql, conn, params)
+        # Most traded taxa first, the search index keeps this order as ranking
+        df = df.sort_values(["amount", "Taxon"], ascending=[False, True], ignore_index=True)
         df = df.rename(columns={"Taxon": "value", "amount": "label"})
         df["label"] = df["value"].astype(str) + " (Entries: " + df["label"].astype(str) + ")"
         df.set_index("value")
@@ -86,83 +190,390 @@ def build_dropdown_species():
 
 
 """
-Create a temporary table in the sqlite database with Species Data
+Most traded taxa
+Ranked by amount (entries in the shipments), like the dropdown.
 """
 
 
-def build_main_df(input_taxon, conn, ctxtriggered_id):
-    if ctxtriggered_id == "input_taxon":
-        try:
-            sql = "CREATE TEMPORARY TABLE temp.taxon AS SELECT Year, Appendix, Taxon, Family, Term, ifnull(Quantity, 'Unknown') AS Quantity, ifnull(Unit, 'Unknown') AS Unit, ifnull(Importer, 'Unknown') AS Importer, ifnull(Exporter, 'Unknown') AS Exporter, Origin, ifnull(Purpose,'Missing Data') AS Purpose, ifnull(Source,'Missing Data') AS Source FROM shipments WHERE Taxon=\"{}\"".format(
-                input_taxon)
-            conn.execute(sql)
-            print("Temporary taxon table created.")
-        except sqlite3.Error as err:
-            print(f"The error '{err}' occurred while 'creating temporary taxon table' in build_main_df")
-            try:
-                sql = "DELETE FROM temp.taxon"
-                conn.execute(sql)
-                sql = "INSERT INTO temp.taxon SELECT Year, Appendix, Taxon, Family, Term, ifnull(Quantity, 'Unknown') AS Quantity, ifnull(Unit, 'Unknown') AS Unit, ifnull(Importer, 'Unknown') AS Importer, ifnull(Exporter, 'Unknown') AS Exporter, Origin, ifnull(Purpose,'Missing Data') AS Purpose, ifnull(Source,'Missing Data') AS Source FROM shipments WHERE Taxon=\"{}\"".format(input_taxon)
-                conn.execute(sql)
-            except sqlite3.Error as err:
-                print(f"The error '{err}' occurred while 'copying data into temp table' in build_main_df")
+def get_top_taxa(conn, limit):
+    sql = "SELECT Taxon FROM distinct_table_amount GROUP BY Taxon ORDER BY SUM(amount) DESC, Taxon LIMIT ?"
+    try:
+        return [row[0] for row in conn.execute(sql, (limit,))]
+    except sqlite3.Error as err:
+        print(f"The error '{err}' occurred during get_top_taxa")
+        return []
+
+
+"""
+Species search index
+Trigram index over the taxon names of the dropdown. The taxa keep the order of the dropdown
+(most entries first), so the first matches are the best ranked and a search stops after limit
+matches. Matching is case insensitive and needs at least three characters.
+"""
+
+species_search_limit = 50
+
+
+def build_species_search_index(dropdown):
+    names = [o["value"] for o in dropdown]
+    lower = [str(name).lower() for name in names]
+    postings = {}
+    for position, name in enumerate(lower):
+        for trigram in {name[i:i + 3] for i in range(len(name) - 2)}:
+            postings.setdefault(trigram, []).append(position)
+    return {
+        "names": names,
+        "labels": [o["label"] for o in dropdown],
+        "lower": lower,
+        "trigrams": {trigram: np.array(positions, dtype=np.int32) for trigram, positions in postings.items()},
+    }
+
+
+def search_species(index, search_value, limit=species_search_limit):
+    query = search_value.lower()
+    trigrams = {query[i:i + 3] for i in range(len(query) - 2)}
+    if not trigrams:
+        return []
+    postings = [index["trigrams"].get(trigram) for trigram in trigrams]
+    if any(positions is None for positions in postings):
+        return []
+    # Intersect the shortest posting lists first
+    postings.sort(key=len)
+    candidates = postings[0]
+    for positions in postings[1:]:
+        candidates = np.intersect1d(candidates, positions, assume_unique=True)
+    results = []
+    for position in candidates.tolist():
+        # Trigrams can match without the whole query matching
+        if query in index["lower"][position]:
+            results.append({"value": index["names"][position], "label": index["labels"][position]})
+            if len(results) == limit:
+                break
+    return results
+
+
+"""
+Species search index snapshot
+The index is built on the first search, or loaded from a snapshot file next to the database.
+build_database writes the snapshot; it is only used if it belongs to the current database build.
+"""
+
+species_search_index = None
+species_search_index_lock = threading.Lock()
+
+
+def species_index_snapshot_path(database):
+    return database + "_species_index.pickle"
+
+
+def save_species_search_index(database, index, build_id):
+    # Several workers can save the snapshot at once, each writes its own file and replaces the snapshot
+    path = species_index_snapshot_path(database)
+    temp_path = "{0}.{1}.{2}.tmp".format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(temp_path, "wb") as f:
+            pickle.dump({"build_id": build_id, "index": index}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+    except OSError as err:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        print(f"The error '{err}' occurred while saving the species search index")
 
 
+def load_species_search_index(database, build_id):
+    try:
+        with open(species_index_snapshot_path(database), "rb") as f:
+            snapshot = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    if snapshot.get("build_id") != build_id:
+        return None
+    return snapshot["index"]
+
+
+def write_species_search_index(database):
+    conn = connect_sqlite3(database)
+    build_id = get_database_build_id(conn)
+    conn.close()
+    save_species_search_index(database, build_species_search_index(build_dropdown_species(database)), build_id)
+    print("Species search index snapshot written")
+
+
+def get_species_search_index(database):
+    global species_search_index
+    with species_search_index_lock:
+        if species_search_index is None:
+            conn = connect_sqlite3_readonly(database)
+            build_id = get_database_build_id(conn)
+            conn.close()
+            # Databases without a build id can not tell whether a snapshot is current
+            index = load_species_search_index(database, build_id) if build_id else None
+            if index is None:
+                index = build_species_search_index(build_dropdown_species(database))
+                if build_id:
+                    save_species_search_index(database, index, build_id)
+            species_search_index = index
+        return species_search_index
+
 
 """
-Get all uniques in temporary table attribute
+Request coalescing
+Selecting a species fires several callbacks at almost the same time, which ask for the same data.
+The first caller of a key computes the result, callers with the same key wait for it instead of
+computing it again. The result is kept for a short time (ttl seconds) after it is computed.
 """
 
+coalesce_lock = threading.Lock()
+coalesce_pending = {}
+coalesce_results = {}
+coalesce_ttl = 10.0
+coalesce_stats = {"computed": 0, "waited": 0, "hits": 0}
+
+
+def coalesce(key, compute, ttl=coalesce_ttl):
+    while True:
+        with coalesce_lock:
+            now = time.monotonic()
+            if key in coalesce_results and coalesce_results[key][0] > now:
+                coalesce_stats["hits"] += 1
+                return coalesce_results[key][1]
+            pending = coalesce_pending.get(key)
+            owner = pending is None
+            if owner:
+                pending = {"done": threading.Event(), "ok": False, "result": None}
+                coalesce_pending[key] = pending
+        if not owner:
+            pending["done"].wait()
+            if pending["ok"]:
+                with coalesce_lock:
+                    coalesce_stats["waited"] += 1
+                return pending["result"]
+            # The first caller failed, try again
+            continue
+        try:
+            pending["result"] = compute()
+            pending["ok"] = True
+            with coalesce_lock:
+                coalesce_stats["computed"] += 1
+                if ttl:
+                    now = time.monotonic()
+                    for expired in [k for k, (expires, _) in coalesce_results.items() if expires <= now]:
+                        del coalesce_results[expired]
+                    coalesce_results[key] = (now + ttl, pending["result"])
+            return pending["result"]
+        finally:
+            with coalesce_lock:
+                del coalesce_pending[key]
+            pending["done"].set()
 
-def get_unique_values(attribute, conn):
-    sql = "SELECT DISTINCT {} FROM temp.taxon".format(attribute)
-    df = run_query(sql, conn)
-    df = df.fillna(value="Unknown")
-    return df[attribute].values.tolist()
+
+def coalesce_info():
+    with coalesce_lock:
+        return dict(coalesce_stats, pending=len(coalesce_pending), results=len(coalesce_results))
 
 
 """
-Convert Python List to SQL List
+Per-taxon cache of shipment data
+The shipments of a taxon are loaded once into a DataFrame of categorical columns and kept in an
+LRU cache, bounded by number of taxa and memory. Charts and map filter the cached data directly,
+so users looking at different taxa no longer share (and overwrite) one temporary table.
+The cache is dropped when the database is rebuilt (see get_database_build_id).
 """
 
+taxon_cache = OrderedDict()
+taxon_cache_lock = threading.Lock()
+taxon_cache_build_id = None
+taxon_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "bytes": 0}
+taxon_cache_max_entries = 32
+taxon_cache_max_bytes = 512 * 1024 * 1024
+
 
-def list_to_sql(Plist):
-    citations = lambda x: """ + str(x) + """
-    Plist = map(citations, Plist)
-    SQLlist = "(" + ", ".join(map(str, Plist)) + ")"
-    return SQLlist
+def get_taxon_data(input_taxon, conn):
+    global taxon_cache_build_id
+    build_id = get_database_build_id(conn)
+    with taxon_cache_lock:
+        if build_id != taxon_cache_build_id:
+            taxon_cache.clear()
+            taxon_cache_stats["bytes"] = 0
+            taxon_cache_build_id = build_id
+        if input_taxon in taxon_cache:
+            taxon_cache.move_to_end(input_taxon)
+            taxon_cache_stats["hits"] += 1
+            return taxon_cache[input_taxon]
+        taxon_cache_stats["misses"] += 1
+    # Concurrent misses of the same taxon load it once
+    df = coalesce(("taxon", build_id, input_taxon), lambda: load_taxon_data(input_taxon, conn), ttl=0)
+    if df is None:
+        return None
+    size = int(df.memory_usage(deep=True).sum())
+    with taxon_cache_lock:
+        if build_id != taxon_cache_build_id:
+            # The database was rebuilt while loading, the data is not kept
+            return df
+        if input_taxon not in taxon_cache:
+            taxon_cache[input_taxon] = df
+            taxon_cache_stats["bytes"] += size
+        # Evict least recently used taxa, but always keep the newest
+        while len(taxon_cache) > 1 and (len(taxon_cache) > taxon_cache_max_entries or
+                                         taxon_cache_stats["bytes"] > taxon_cache_max_bytes):
+            evicted_taxon, evicted_df = taxon_cache.popitem(last=False)
+            taxon_cache_stats["bytes"] -= int(evicted_df.memory_usage(deep=True).sum())
+            taxon_cache_stats["evictions"] += 1
+        return taxon_cache[input_taxon]
+
+
+def taxon_cache_info():
+    with taxon_cache_lock:
+        return dict(taxon_cache_stats, entries=len(taxon_cache))
 
 
 """
-Retrieve and transform data needed for shipments in map graph
+Shipment counts (per-taxon cube)
+Number of shipments per Taxon, Year, Term, Purpose, Source, Exporter and Importer. Every view of the
+dashboard is a sum over these cells, and a taxon has far fewer cells than shipments.
 """
 
+shipment_counts_columns = ["Taxon", "Year", "Term", "ifnull(Purpose,'Missing Data') AS Purpose",
+                           "ifnull(Source,'Missing Data') AS Source", "ifnull(Exporter, 'Unknown') AS Exporter",
+                           "ifnull(Importer, 'Unknown') AS Importer", "COUNT(*) AS Count"]
+shipment_counts_group_by = ["Taxon", "Year", "Term", "ifnull(Purpose,'Missing Data')", "ifnull(Source,'Missing Data')",
+                            "ifnull(Exporter, 'Unknown')", "ifnull(Importer, 'Unknown')"]
+
+taxon_columns = ["Year", "Term", "Purpose", "Source", "Exporter", "Importer", "Count"]
+taxon_categorical_columns = ["Term", "Purpose", "Source", "Exporter", "Importer"]
 
-def get_data_map_graph(temporal_input, filter_terms, filter_purpose, filter_source, conn):
+
+def create_shipment_counts_table(conn):
+    drop_table_if_exist(conn, "shipment_counts")
     try:
-        sql_start = "SELECT Year, Importer, Exporter FROM temp.taxon WHERE Year<={0} AND Term IN {1} AND".format(
-            temporal_input, list_to_sql(filter_terms))
-        sql_purpose = "Purpose IN {0}".format(list_to_sql(filter_purpose))
-        sql_purpose_null = "OR Purpose IS NULL"
-        sql_source = "Source IN {0}".format(list_to_sql(filter_source))
-        sql_source_null = "OR Source IS NULL"
-        sql_end = "ORDER BY Year"
-
-        if "Unknown" in filter_purpose:
-            sql = sql_start + " (" + sql_purpose + " " + sql_purpose_null + ")"
-        else:
-            sql = sql_start + " " + sql_purpose
-        if "Unknown" in filter_source:
-            sql = sql + " AND (" + sql_source + " " + sql_source_null + ")" + " " + sql_end
-        else:
-            sql = sql + " AND " + sql_source + " " + sql_end
-        df = run_query(sql, conn)
+        sql, params = qb.select("shipments", shipment_counts_columns, group_by=shipment_counts_group_by)
+        conn.execute("CREATE TABLE shipment_counts AS " + sql, params)
+        conn.execute("CREATE INDEX shipment_counts_taxon_year ON shipment_counts (Taxon, Year)")
+        cells = conn.execute("SELECT COUNT(*) FROM shipment_counts").fetchone()[0]
+        rows = conn.execute("SELECT COUNT(*) FROM shipments").fetchone()[0]
+        print(f"Shipment counts table successfully created ({cells} cells for {rows} shipments).")
     except sqlite3.Error as err:
-        print(f"The error '{err}' occurred while 'getting data from temp table' in get_data_map_graph")
+        print(f"The error '{err}' occurred while creating shipment counts table")
+
 
+def load_taxon_data(input_taxon, conn):
+    sql, params = qb.select("shipment_counts", taxon_columns, equals={"Taxon": input_taxon}, order_by=["Year"])
+    if not table_exists(conn, "shipment_counts"):
+        # Database built before the shipment counts table, count the shipments of the taxon instead
+        sql, params = qb.select("shipments", shipment_counts_columns, equals={"Taxon": input_taxon},
+                                group_by=shipment_counts_group_by, order_by=["Year"])
+    try:
+        df = pd.read_sql_query(sql, conn, params=params)
+    except sqlite3.Error as err:
+        print(f"The error '{err}' occurred while 'loading taxon data' in load_taxon_data")
+        return None
+    df = df[taxon_columns]
+    df["Year"] = df["Year"].astype(np.int16)
+    df["Count"] = df["Count"].astype(np.int32)
+    for col in taxon_categorical_columns:
+        df[col] = df[col].astype("category")
     return df
 
 
+def get_taxon_family(input_taxon, conn):
+    sql, params = qb.select("distinct_table_amount", ["Family"], equals={"Taxon": input_taxon})
+    family = conn.execute(sql, params).fetchone()
+    return family[0] if family else None
+
+
+"""
+Load Species Data into the taxon cache
+"""
+
+
+def build_main_df(input_taxon, conn, ctxtriggered_id):
+    df = get_taxon_data(input_taxon, conn)
+    if ctxtriggered_id == "input_taxon":
+        info = taxon_cache_info()
+        print(f"Taxon data ready. Cache hits: {info['hits']}, misses: {info['misses']}, "
+              f"evictions: {info['evictions']}, entries: {info['entries']}, size: {info['bytes'] / 1e6:.1f} MB")
+    return df
+
+
+"""
+Filter the Species Data on year, terms, purposes and sources
+All years are kept if temporal_input is None. get_filtered_taxon_data coalesces equal selections.
+"""
+
+
+def filter_taxon_data(df, temporal_input, filter_terms, filter_purpose, filter_source):
+    term_mask = df["Term"].isin(filter_terms).to_numpy()
+    if "Unknown" in filter_terms:
+        term_mask |= df["Term"].isna().to_numpy()
+    mask = term_mask
+    if temporal_input is not None:
+        mask &= df["Year"].to_numpy() <= int(temporal_input)
+    mask &= df["Purpose"].isin(filter_purpose).to_numpy()
+    mask &= df["Source"].isin(filter_source).to_numpy()
+    return df[mask]
+
+
+def get_filtered_taxon_data(input_taxon, temporal_input, filter_terms, filter_purpose, filter_source, conn):
+    # Filter order does not matter, sorted tuples make equal selections share one key.
+    # Filters can hold None (missing values), so they are sorted by repr.
+    # Results are kept for coalesce_ttl, the build id keeps them from outliving a rebuild.
+    key = ("filtered", get_database_build_id(conn), input_taxon,
+           None if temporal_input is None else int(temporal_input), tuple(sorted(filter_terms, key=repr)),
+           tuple(sorted(filter_purpose, key=repr)), tuple(sorted(filter_source, key=repr)))
+    return coalesce(key, lambda: filter_taxon_data(get_taxon_data(input_taxon, conn), temporal_input, filter_terms,
+                                                   filter_purpose, filter_source))
+
+
+"""
+Get all uniques in Species Data attribute
+"""
+
+
+def get_unique_values(input_taxon, attribute, conn):
+    df = get_taxon_data(input_taxon, conn)
+    values = df[attribute].astype(object).fillna(value="Unknown")
+    return values.unique().tolist()
+
+
+"""
+Retrieve data for the line diagrams (Term, Source and Purpose per Year)
+All three breakdowns are summed from one groupby over the category codes of the filtered cells.
+The attributes are returned as categoricals, so the diagrams can work on the codes as well.
+"""
+
+line_diagram_attributes = ["Term", "Source", "Purpose"]
+
+
+def get_data_line_diagrams(input_taxon, temporal_input, filter_terms, filter_purpose, filter_source, conn):
+    df = get_filtered_taxon_data(input_taxon, temporal_input, filter_terms, filter_purpose, filter_source, conn)
+    # Missing values have code -1 and are kept in the groupby, so they count for the other attributes
+    codes = pd.DataFrame({attribute: df[attribute].cat.codes for attribute in line_diagram_attributes})
+    codes["Year"] = df["Year"].to_numpy()
+    codes["Count"] = df["Count"].to_numpy()
+    counts = codes.groupby(line_diagram_attributes + ["Year"])["Count"].sum()
+    result = {}
+    for attribute in line_diagram_attributes:
+        attribute_counts = counts.groupby(level=[attribute, "Year"]).sum().reset_index(name="Count")
+        attribute_counts = attribute_counts[attribute_counts[attribute] >= 0]
+        attribute_counts = attribute_counts.sort_values(["Year", attribute]).reset_index(drop=True)
+        attribute_counts[attribute] = pd.Categorical.from_codes(attribute_counts[attribute].to_numpy(),
+                                                                df[attribute].cat.categories)
+        attribute_counts["Year"] = attribute_counts["Year"].astype(int)
+        result[attribute] = attribute_counts[[attribute, "Year", "Count"]]
+    return result
+
+
+"""
+Retrieve and transform data needed for shipments in map graph
+"""
+
+
+def get_data_map_graph(input_taxon, temporal_input, filter_terms, filter_purpose, filter_source, conn):
+    df = get_filtered_taxon_data(input_taxon, temporal_input, filter_terms, filter_purpose, filter_source, conn)
+    df = df[["Year", "Importer", "Exporter", "Count"]].astype({"Year": int, "Importer": object, "Exporter": object})
+    return df.reset_index(drop=True)
+
+
 """
 Retrieve data from CITES+ database, related to the current species.
 """
@@ -213,11 +624,344 @@ def ready_aux_databases(cites_plus_csv, cites_checklist_csv):
                  ]
 
 
+"""
+Indexes on the shipments table
+Chosen from the queries of the dashboard:
+(Taxon, Year) serves the species selection (WHERE Taxon=...) and the per-taxon shipment counts,
+Importer and Exporter are covering indexes for the imports and exports tables.
+A separate index on Taxon alone is not needed, as it is the prefix of (Taxon, Year).
+"""
+
+shipments_indexes = {
+    "shipments_taxon_year": "shipments (Taxon, Year)",
+    "shipments_importer": "shipments (Importer)",
+    "shipments_exporter": "shipments (Exporter)",
+}
+
+# Expected query plan for the queries on the shipments table (query, parameters, index that must be used)
+query_plan_expectations = [
+    (*qb.select("shipments", shipment_counts_columns, equals={"Taxon": "Psittacus erithacus"},
+                group_by=shipment_counts_group_by), "shipments_taxon_year"),
+    (*qb.select("shipment_counts", taxon_columns, equals={"Taxon": "Psittacus erithacus"}, order_by=["Year"]),
+     "shipment_counts_taxon_year"),
+    (*qb.select("shipments", ["Importer", "COUNT(Importer)"], group_by=["Importer"]), "shipments_importer"),
+    (*qb.select("shipments", ["Exporter", "COUNT(Exporter)"], group_by=["Exporter"]), "shipments_exporter"),
+]
+
+
+def create_shipments_indexes(conn):
+    for index, columns in shipments_indexes.items():
+        try:
+            sql = "CREATE INDEX IF NOT EXISTS {0} ON {1}".format(index, columns)
+            conn.execute(sql)
+            print(f"Index {index} successfully created")
+        except sqlite3.Error as err:
+            print(f"The error '{err}' occurred while creating index {index}")
+
+
+def check_query_plans(conn):
+    plans_ok = True
+    for sql, params, index in query_plan_expectations:
+        try:
+            plan = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+        except sqlite3.Error as err:
+            print(f"The error '{err}' occurred during check_query_plans")
+            plans_ok = False
+            continue
+        details = " | ".join(str(step[-1]) for step in plan)
+        if index not in details:
+            print(f"WARNING: Query does not use index {index}: {sql} ({details})")
+            plans_ok = False
+    if plans_ok:
+        print("Query plans use the expected indexes")
+    return plans_ok
+
+
+"""
+Parallel CSV import
+Worker processes parse and type-convert the CSV files in chunks and pass them to a single writer.
+The queue between the workers and the writer is bounded, so memory use does not depend on file size.
+Every file has a slot in the manifest, and its rows get the rowids slot << 32 + row number,
+so the rows of a file can be found (and replaced) as one rowid range.
+Returns the number of rows of every file that was imported completely. Files that failed are left
+in the manifest as 'importing'.
+"""
+
+ingest_queue = None
+
+# PRAGMAs for bulk loading (set before the import) and their defaults (restored after the import)
+bulk_load_pragmas = ["PRAGMA journal_mode=WAL", "PRAGMA synchronous=OFF", "PRAGMA cache_size=-262144",
+                     "PRAGMA temp_store=MEMORY"]
+default_pragmas = ["PRAGMA journal_mode=DELETE", "PRAGMA synchronous=FULL", "PRAGMA cache_size=-2000",
+                   "PRAGMA temp_store=DEFAULT"]
+
+
+def slot_rowid_range(slot):
+    return slot << 32, (slot + 1) << 32
+
+
+def init_ingest_worker(queue):
+    global ingest_queue
+    ingest_queue = queue
+
+
+def parse_csv_file(file, slot, dtypes_dict, chunksize):
+    rows = 0
+    rowid_start, rowid_end = slot_rowid_range(slot)
+    try:
+        with open(file, "rb") as f:
+            for chunk in pd.read_csv(f, dtype=dtypes_dict, chunksize=chunksize):
+                missing = [col for col in dtypes_dict if col not in chunk.columns]
+                if missing:
+                    raise ValueError("missing columns {0}".format(", ".join(missing)))
+                # Values in the column order of the INSERT, not of the csv header
+                chunk = chunk[list(dtypes_dict)]
+                chunk = chunk.astype(object).where(chunk.notna(), None)
+                chunk.index = range(rowid_start + rows, rowid_start + rows + len(chunk))
+                records = list(chunk.itertuples(index=True, name=None))
+                rows += len(records)
+                # Position in file is used for the time estimate
+                ingest_queue.put(("chunk", file, records, f.tell()))
+    except Exception as err:
+        # Always report back, otherwise the writer waits for the file forever
+        ingest_queue.put(("error", file, str(err), 0))
+        return
+    ingest_queue.put(("done", file, rows, os.path.getsize(file)))
+
+
+def ingest_csv_files(conn, table, manifest_entries, dtypes_dict, processes=None, chunksize=50000,
+                     transaction_rows=1000000):
+    csv_files = [entry["path"] for entry in manifest_entries]
+    entries = {entry["path"]: entry for entry in manifest_entries}
+    processes = processes or max(1, min(len(csv_files), (os.cpu_count() or 2) - 1))
+    # At most two chunks per worker are waiting for the writer
+    queue = multiprocessing.Queue(maxsize=2 * processes)
+    sql = "INSERT INTO {0} (rowid, {1}) VALUES ({2})".format(
+        table, ", ".join("\"{0}\"".format(col) for col in dtypes_dict), ", ".join(["?"] * (len(dtypes_dict) + 1)))
+    for pragma in bulk_load_pragmas:
+        conn.execute(pragma)
+    total_files = len(csv_files)
+    total_bytes = sum(os.path.getsize(file) for file in csv_files)
+    bytes_read = {file: 0 for file in csv_files}
+    rows_per_file = {}
+    # Files with a chunk that could not be written stay 'importing' and are imported again next build
+    failed_files = set()
+    files_finished = 0
+    rows_in_transaction = 0
+    start_time = time.perf_counter()
+    with multiprocessing.Pool(processes, initializer=init_ingest_worker, initargs=(queue,)) as pool:
+        result = pool.starmap_async(parse_csv_file, [(file, entries[file]["slot"], dtypes_dict, chunksize)
+                                                     for file in csv_files])
+        while files_finished < total_files:
+            message, file, payload, position = queue.get()
+            if message == "chunk":
+                try:
+                    conn.executemany(sql, payload)
+                except sqlite3.Error as err:
+                    print(f"The error '{err}' occurred while importing {file}")
+                    failed_files.add(file)
+                rows_in_transaction += len(payload)
+                bytes_read[file] = position
+                if rows_in_transaction >= transaction_rows:
+                    conn.commit()
+                    rows_in_transaction = 0
+                continue
+            files_finished += 1
+            if message == "error":
+                print(f"The error '{payload}' occurred while importing {file}")
+                continue
+            if file in failed_files:
+                conn.commit()
+                rows_in_transaction = 0
+                print(f"{file} was not imported completely ({files_finished}/{total_files}), "
+                      f"it is imported again on the next build.")
+                continue
+            rows_per_file[file] = payload
+            bytes_read[file] = position
+            # The file is only complete in the manifest once all its rows are committed
+            update_manifest_entry(conn, entries[file], "complete", payload)
+            conn.commit()
+            rows_in_transaction = 0
+            # Estimate remaining time from the share of bytes imported
+            run_time = time.perf_counter() - start_time
+            time_remain = run_time * (total_bytes - sum(bytes_read.values())) / max(sum(bytes_read.values()), 1)
+            time_remain = str(datetime.timedelta(seconds=time_remain))
+            print(f"{file} imported successfully ({files_finished}/{total_files}). Time Remaining: {time_remain[0:8]}")
+        result.get()
+    conn.commit()
+    for pragma in default_pragmas:
+        conn.execute(pragma)
+    return rows_per_file
+
+
+"""
+Import manifest
+Records size, modification time, content hash and rowid range of every imported csv file.
+Unchanged files are skipped on the next build, changed files are replaced and files that were
+interrupted during import (status 'importing') are imported again.
+"""
+
+
+def create_manifest_table(conn):
+    try:
+        sql = "CREATE TABLE IF NOT EXISTS import_manifest (file TEXT PRIMARY KEY, slot INTEGER, size INTEGER, " \
+              "mtime REAL, hash TEXT, rowid_start INTEGER, rowid_end INTEGER, rows INTEGER, status TEXT)"
+        conn.execute(sql)
+    except sqlite3.Error as err:
+        print(f"The error '{err}' occurred while creating import manifest")
+
+
+def hash_file(file):
+    sha = hashlib.sha1()
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def compare_manifest(conn, csv_files):
+    manifest = run_query("SELECT * FROM import_manifest", conn).set_index("file").to_dict("index")
+    next_slot = max([entry["slot"] for entry in manifest.values()], default=0) + 1
+    import_entries = []
+    for path in csv_files:
+        file = os.path.basename(path)
+        stat = os.stat(path)
+        entry = {"file": file, "path": path, "size": stat.st_size, "mtime": stat.st_mtime, "hash": None}
+        previous = manifest.pop(file, None)
+        if previous is not None:
+            entry["slot"] = int(previous["slot"])
+            if previous["status"] == "complete":
+                if previous["size"] == entry["size"] and previous["mtime"] == entry["mtime"]:
+                    continue
+                entry["hash"] = hash_file(path)
+                if previous["hash"] == entry["hash"]:
+                    # Touched, but the content is unchanged
+                    conn.execute("UPDATE import_manifest SET mtime=? WHERE file=?", (entry["mtime"], file))
+                    continue
+        else:
+            entry["slot"] = next_slot
+            next_slot += 1
+        if entry["hash"] is None:
+            entry["hash"] = hash_file(path)
+        import_entries.append(entry)
+    # Files left in the manifest are no longer in the csv directory
+    removed_entries = [{"file": file, "slot": int(previous["slot"])} for file, previous in manifest.items()]
+    conn.commit()
+    return import_entries, removed_entries
+
+
+def update_manifest_entry(conn, entry, status, rows=0):
+    rowid_start, rowid_end = slot_rowid_range(entry["slot"])
+    sql = "INSERT OR REPLACE INTO import_manifest VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    conn.execute(sql, (entry["file"], entry["slot"], entry["size"], entry["mtime"], entry["hash"],
+                       rowid_start, rowid_start + rows - 1, rows, status))
+
+
+def reset_untracked_shipments(conn, table):
+    # A new shipments table can not be described by an old manifest
+    if not table_exists(conn, table):
+        conn.execute("DELETE FROM import_manifest")
+        conn.commit()
+        return
+    # Rows of a table built without a manifest (empty manifest, or rowids below the first slot)
+    # are not in any slot, so they would never be replaced and every file would be imported twice
+    manifest_files = conn.execute("SELECT COUNT(*) FROM import_manifest").fetchone()[0]
+    untracked = conn.execute("SELECT 1 FROM {0} WHERE rowid<? LIMIT 1".format(table),
+                             (slot_rowid_range(1)[0],)).fetchone()
+    if manifest_files == 0 or untracked is not None:
+        print("The shipments table was not built with an import manifest, all csv files are imported again.")
+        drop_table_if_exist(conn, table)
+        conn.execute("DELETE FROM import_manifest")
+        conn.commit()
+
+
+def collect_affected_keys(conn, table, entries, affected_taxa, affected_countries):
+    # Taxa and countries in the rowid range of the files, used to refresh the auxiliary tables
+    for entry in entries:
+        rowid_start, rowid_end = slot_rowid_range(entry["slot"])
+        sql = "SELECT DISTINCT Taxon, Importer, Exporter FROM {0} WHERE rowid>=? AND rowid<?".format(table)
+        for taxon, importer, exporter in conn.execute(sql, (rowid_start, rowid_end)):
+            affected_taxa.add(taxon)
+            affected_countries.update([importer, exporter])
+
+
+def remove_file_rows(conn, table, entries):
+    for entry in entries:
+        rowid_start, rowid_end = slot_rowid_range(entry["slot"])
+        conn.execute("DELETE FROM {0} WHERE rowid>=? AND rowid<?".format(table), (rowid_start, rowid_end))
+        if "path" in entry:
+            update_manifest_entry(conn, entry, "importing")
+        else:
+            conn.execute("DELETE FROM import_manifest WHERE file=?", (entry["file"],))
+    conn.commit()
+
+
+"""
+Auxiliary tables
+A full build creates the tables from all shipments, an incremental build only replaces the rows
+of the affected taxa and countries.
+"""
+
+
+def create_aux_tables(conn):
+    for table in ["distinct_table_amount", "imports", "exports"]:
+        drop_table_if_exist(conn, table)
+    create_shipment_counts_table(conn)
+    # Create table with distinct rows
+    try:
+        sql = "CREATE TABLE distinct_table_amount AS SELECT DISTINCT Taxon, Class, \"Order\", Family, Genus, COUNT(Importer) as 'amount' FROM shipments GROUP BY Taxon, Class, \"Order\", Family, Genus"
+        conn.execute(sql)
+        print("Distinct Auxiliary Table successfully created. Only two more to go...")
+    except sqlite3.Error as err:
+        print(f"The error '{err}' occurred while creating Distinct Auxiliary Table")
+    # Create tables for specific data
+    try:
+        sql = "CREATE TABLE imports AS SELECT Importer as 'Country', COUNT(Importer) as 'Imports' from shipments GROUP BY Importer"
+        conn.execute(sql)
+        print("Imports table successfully created. Almost there...")
+    except sqlite3.Error as err:
+        print(f"The error '{err}' occurred while creating imports table")
+    try:
+        sql = "CREATE TABLE exports AS SELECT Exporter as 'Country', COUNT(Exporter) as 'Exports' from shipments GROUP BY Exporter"
+        conn.execute(sql)
+        print("Exports table successfully created.")
+    except sqlite3.Error as err:
+        print(f"The error '{err}' occurred while creating exports table")
+
+
+def refresh_aux_tables(conn, affected_taxa, affected_countries):
+    taxa = {"Taxon": sorted(x for x in affected_taxa if x is not None)}
+    countries = sorted(x for x in affected_countries if x is not None)
+    try:
+        sql, params = qb.select("distinct_table_amount", ["rowid"], in_lists=taxa)
+        conn.execute("DELETE FROM distinct_table_amount WHERE rowid IN ({0})".format(sql), params)
+        sql, params = qb.select("shipments", ["DISTINCT Taxon", "Class", "\"Order\"", "Family", "Genus",
+                                              "COUNT(Importer) as 'amount'"],
+                                in_lists=taxa, group_by=["Taxon", "Class", "\"Order\"", "Family", "Genus"])
+        conn.execute("INSERT INTO distinct_table_amount " + sql, params)
+        sql, params = qb.select("shipment_counts", ["rowid"], in_lists=taxa)
+        conn.execute("DELETE FROM shipment_counts WHERE rowid IN ({0})".format(sql), params)
+        sql, params = qb.select("shipments", shipment_counts_columns, in_lists=taxa, group_by=shipment_counts_group_by)
+        conn.execute("INSERT INTO shipment_counts " + sql, params)
+        for table, column, count in [("imports", "Importer", "Imports"), ("exports", "Exporter", "Exports")]:
+            sql, params = qb.select(table, ["rowid"], in_lists={"Country": countries})
+            conn.execute("DELETE FROM {0} WHERE rowid IN ({1})".format(table, sql), params)
+            sql, params = qb.select("shipments", ["{0} as 'Country'".format(column),
+                                                  "COUNT({0}) as '{1}'".format(column, count)],
+                                    in_lists={column: countries}, group_by=[column])
+            conn.execute("INSERT INTO {0} ".format(table) + sql, params)
+        conn.commit()
+        print(f"Auxiliary tables refreshed for {len(affected_taxa)} taxa and {len(affected_countries)} countries.")
+    except sqlite3.Error as err:
+        print(f"The error '{err}' occurred while refreshing Auxiliary tables")
+
+
 def build_database(database):
-    # Build list of CSV files
-    dir = os.path.dirname(__file__) + "\CITES/"
-    csv_files = os.listdir(dir)
-    csv_files = [dir + x for x in csv_files]
+    # Build list of CSV files (Species+ and History Listings are imported separately)
+    dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "CITES")
+    aux_files = ["species_plus_params_cites_listing.csv", "History_of_CITES_Listings.csv"]
+    csv_files = sorted(x for x in os.listdir(dir) if x.endswith(".csv") and x not in aux_files)
+    csv_files = [os.path.join(dir, x) for x in csv_files]
     # Get columns for database
     with open(csv_files[0], "r") as f:
         csv_reader = csv.DictReader(f)
@@ -239,13 +983,11 @@ def build_database(database):
     conn = connect_sqlite3(database)
     # Create table with cols
     table = "shipments"
-    # Drop table if it already exists
-    sql = "drop table if exists {table}".format(
-        table=table)
-    conn.execute(sql)
-    # Create table
+    create_manifest_table(conn)
+    reset_untracked_shipments(conn, table)
+    # Create table (rows of unchanged files are kept)
     try:
-        sql = "create table {table} ({cols})".format(
+        sql = "create table if not exists {table} ({cols})".format(
             table=table,
             cols=", ".join("'{0}' {1}".format(value, datatypes[index]) for index, value in enumerate(cols)))
         conn.execute(sql)
@@ -265,69 +1007,51 @@ def build_database(database):
                      "str", "str",
                      "int"]
     dtypes_dict = {cols[i]: pandas_dtypes[i] for i in range(len(cols))}
-    print("Starting import of csv files...")
-    i = 1
-    total_files = len(csv_files)
+    print("Comparing csv files with import manifest...")
+    import_entries, removed_entries = compare_manifest(conn, csv_files)
+    complete_files = conn.execute("SELECT COUNT(*) FROM import_manifest WHERE status='complete'").fetchone()[0]
+    if not import_entries and not removed_entries:
+        print("All csv files are unchanged since the last build.")
+    affected_taxa, affected_countries = set(), set()
+    collect_affected_keys(conn, table, import_entries + removed_entries, affected_taxa, affected_countries)
+    remove_file_rows(conn, table, import_entries + removed_entries)
+    print(f"Starting import of {len(import_entries)} csv files ({len(csv_files) - len(import_entries)} unchanged)...")
     # Debug option for database testing
     debug = False
-    total_rows_proc = 0
-    # Timers, for convenience.
-    process_times = []
-    avg_processtime = 0
-    total_processtime = 0
-    time_remain = 0
-    for file in csv_files:
-        try:
-            # Using pandas df is faster than iterating over rows
-            start_time = time.perf_counter()
-            df = pd.read_csv(file, dtype=dtypes_dict)
-            df.to_sql(table, conn, if_exists="append", index=False)
-            # Calculate run time
-            end_time = time.perf_counter()
-            run_time = end_time - start_time
-            process_times.append(run_time)
-            avg_processtime = sum(process_times) / len(process_times)
-            time_remain = (total_files - i) * avg_processtime
-            time_remain = str(datetime.timedelta(seconds=time_remain))
-            print(f"{file} imported successfully ({i}/{total_files}). Time Remaining: {time_remain[0:8]}")
-            if debug:
-                # Database stability check (Calculate if database has the correct size)
-                print("WARNING: Debug is active. Import will be a lot slower.")
-                df_rows = len(df)
-                total_rows_proc = total_rows_proc + df_rows
-                db_rows = conn.execute("SELECT Count(*) FROM shipments")
-                db_rows = db_rows.fetchone()[0]
-                print(f"Rows in DF: {df_rows}. Total rows processed: {total_rows_proc}. Current rows in DB: {db_rows}.")
-                if total_rows_proc != db_rows:
-                    raise ValueError("Mismatch in database. Stopping import...")
-            i += 1
-        except sqlite3.Error as err:
-            print(f"The error '{err}' occurred while importing {file}")
+    if import_entries:
+        rows_per_file = ingest_csv_files(conn, table, import_entries, dtypes_dict)
+        failed_files = [entry["file"] for entry in import_entries if entry["path"] not in rows_per_file]
+        if failed_files:
+            print(f"The import of {len(failed_files)} csv files failed, they are imported again on the next "
+                  f"build: {', '.join(failed_files)}")
+    collect_affected_keys(conn, table, import_entries, affected_taxa, affected_countries)
+    if debug:
+        # Database stability check (Calculate if database has the correct size)
+        total_rows_proc = conn.execute("SELECT SUM(rows) FROM import_manifest").fetchone()[0]
+        db_rows = conn.execute("SELECT Count(*) FROM shipments")
+        db_rows = db_rows.fetchone()[0]
+        print(f"Total rows in manifest: {total_rows_proc}. Current rows in DB: {db_rows}.")
+        if total_rows_proc != db_rows:
+            raise ValueError("Mismatch in database. Stopping import...")
     print("CSV files imported successfully")
-    print("Creating Auxiliary tables.. This will take a minute.. or two.")
-    # Create table with distinct rows
-    try:
-        sql = "CREATE TABLE distinct_table_amount AS SELECT DISTINCT Taxon, Class, \"Order\", Family, Genus, COUNT(Importer) as 'amount' FROM shipments GROUP BY Taxon, Class, \"Order\", Family, Genus,"
-        conn.execute(sql)
-        print("Distinct Auxiliary Table successfully created. Only two more to go...")
-    except sqlite3.Error as err:
-        print(f"The error '{err}' occurred while creating Distinct Auxiliary Table")
-    # Create tables for specific data
-    try:
-        sql = "CREATE TABLE imports AS SELECT Importer as 'Country', COUNT(Importer) as 'Imports' from shipments GROUP BY Importer,"
-        conn.execute(sql)
-        print("Imports table successfully created. Almost there...")
-    except sqlite3.Error as err:
-        print(f"The error '{err}' occurred while creating imports table")
-    try:
-        sql = "CREATE TABLE exports AS SELECT Exporter as 'Country', COUNT(Exporter) as 'Exports' from shipments GROUP BY Exporter,"
-        conn.execute(sql)
-        print("Exports table successfully created.")
-    except sqlite3.Error as err:
-        print(f"The error '{err}' occurred while creating exports table")
+    print("Creating indexes..")
+    create_shipments_indexes(conn)
+    aux_tables_exist = all(table_exists(conn, x) for x in ["distinct_table_amount", "imports", "exports",
+                                                          "shipment_counts"])
+    if complete_files == 0 or not aux_tables_exist:
+        print("Creating Auxiliary tables.. This will take a minute.. or two.")
+        create_aux_tables(conn)
+    elif affected_taxa or affected_countries:
+        print("Refreshing Auxiliary tables for changed files..")
+        refresh_aux_tables(conn, affected_taxa, affected_countries)
+    # Update statistics for the query planner and check that the indexes are used
+    conn.execute("ANALYZE")
+    check_query_plans(conn)
+    mark_database_build(conn)
     print("Main Database creation complete")
     print("Create species+ database")
     build_species_plus_table("cites")
+    write_species_search_index("cites")
 
 
 def build_species_plus_table(database):
@@ -365,9 +1089,69 @@ def build_species_plus_table(database):
         df.to_sql(table, conn, if_exists="replace", index=False)
     except sqlite3.Error as err:
         print(f"The error '{err}' occurred while importing species + database")
+    try:
+        conn.execute("CREATE INDEX IF NOT EXISTS species_plus_name ON species_plus (\"Scientific Name\")")
+    except sqlite3.Error as err:
+        print(f"The error '{err}' occurred while creating index on species + database")
+    build_species_distribution_table(conn, df)
+    mark_database_build(conn)
     print("Species+ Database creation complete")
 
 
+"""
+Species distribution table
+Long format of the distribution columns of species_plus, one row per taxon and country, with the
+ISO-3 code, the distribution statuses (hover text) and the status code of the map color already
+resolved. The map only has to look up the rows of the taxon.
+"""
+
+distribution_status = {"Native_Distribution": "Native",
+                       "Reintroduced_Distribution": "Reintroduced",
+                       "Introduced_Distribution": "Introduced",
+                       "Introduced(?)_Distribution": "Possibly Introduced",
+                       "Distribution_Uncertain": "Uncertain",
+                       "Extinct(?)_Distribution": "Possibly Extinct",
+                       "Extinct_Distribution": "Extinct"}
+
+# A country with several statuses gets the color of the first status found, in this order
+distribution_status_priority = [("Uncertain", 0.5), ("Reintroduced", 0.2), ("Possibly Extinct", 0.6),
+                                ("Extinct", 0.7), ("Native", 0.1), ("Introduced", 0.3),
+                                ("Possibly Introduced", 0.4)]
+
+
+def distribution_status_code(status):
+    for name, code in distribution_status_priority:
+        if name in status:
+            return code
+
+
+def build_species_distribution_table(conn, df):
+    table = "species_distribution"
+    # Statuses of a country are listed in the column order of species_plus
+    columns = [col for col in df.columns if col in distribution_status]
+    df = df.drop_duplicates("Scientific Name")
+    df = df.melt(id_vars="Scientific Name", value_vars=columns, var_name="Distribution", value_name="country")
+    df = df.dropna(subset=["country"])
+    df["country"] = df["country"].str.split(",")
+    df = df.explode("country")
+    df["alpha_3"] = cc.convert_countrycode_column(df["country"], "name", "alpha_3")
+    df["status"] = df["Distribution"].map(distribution_status)
+    df = df.groupby(["Scientific Name", "country", "alpha_3"])["status"].apply("<br> ".join).reset_index()
+    df["status_code"] = df["status"].map(distribution_status_code)
+    df = df.rename(columns={"Scientific Name": "taxon"})
+    drop_table_if_exist(conn, table)
+    try:
+        conn.execute("CREATE TABLE species_distribution (taxon TEXT, country TEXT, alpha_3 TEXT, status TEXT, "
+                     "status_code REAL)")
+        conn.executemany("INSERT INTO species_distribution (taxon, country, alpha_3, status, status_code) "
+                         "VALUES (?, ?, ?, ?, ?)",
+                         df[["taxon", "country", "alpha_3", "status", "status_code"]].itertuples(index=False))
+        conn.execute("CREATE INDEX IF NOT EXISTS species_distribution_taxon ON species_distribution (taxon)")
+        conn.commit()
+    except sqlite3.Error as err:
+        print(f"The error '{err}' occurred while creating the species distribution table")
+
+
 def build_history_table(database):
     history_csv = "CITES/History_of_CITES_Listings.csv"
     # Optimize Pandas Import
@@ -409,4 +1193,9 @@ def build_history_table(database):
         df.to_sql(table, conn, if_exists="replace", index=False)
     except sqlite3.Error as err:
         print(f"The error '{err}' occurred while importing species + database")
+    try:
+        conn.execute("CREATE INDEX IF NOT EXISTS history_listings_name ON history_listings (FullName)")
+    except sqlite3.Error as err:
+        print(f"The error '{err}' occurred while creating index on history listings")
+    mark_database_build(conn)
     print("History Listing Database creation complete")
@@ -0,0 +1,237 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import database_scripts as db
+
+"""
+Shared figure cache
+Figures and tables built for a taxon are stored in a local SQLite file next to the database
+(<database>_figure_cache.db), so all worker processes share them. Entries are keyed by function,
+taxon, year and the sorted filters, and store the build id of the database (db.get_database_build_id)
+together with figure_cache_version, so a rebuild of the database or a change of a cached format
+invalidates them. The least recently used entries are removed when the cache grows over
+figure_cache_max_bytes.
+A hit only reads the cache file. The access times (for the LRU eviction) and the hit/miss counts are
+collected in the process and written in one transaction, together with the next stored entry or at
+the latest after figure_cache_flush_interval seconds.
+"""
+
+# Increase when the format of a cached value changes
+figure_cache_version = 2
+figure_cache_max_bytes = 256 * 1024 * 1024
+figure_cache_flush_interval = 30.0
+# One connection per cache file and process, used under the lock
+figure_cache_connections = {}
+figure_cache_build_ids = {}
+figure_cache_lock = threading.Lock()
+figure_cache_pid = None
+figure_cache_stats = {"hits": 0, "misses": 0, "errors": 0}
+# Not yet written: access time per key and hit/miss counts per function
+figure_cache_pending = {"accessed": {}, "counts": {}, "since": time.monotonic()}
+# Returned by the lookup if the key is not in the cache, a stored value can be None
+figure_cache_absent = object()
+
+
+def normalize_filters(filter_values):
+    if filter_values is None:
+        return None
+    return tuple(sorted(filter_values, key=repr))
+
+
+def figure_cache_key(function, input_taxon, temporal_input=None, filter_terms=None, filter_purpose=None,
+                     filter_source=None, *extra):
+    year = None if temporal_input is None else int(temporal_input)
+    key = (function, input_taxon, year, normalize_filters(filter_terms), normalize_filters(filter_purpose),
+           normalize_filters(filter_source)) + extra
+    return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+
+
+def figure_cache_build_id(conn):
+    return "{0}:{1}".format(db.get_database_build_id(conn), figure_cache_version)
+
+
+def figure_cache_path(conn):
+    # File of the main database of the connection, the cache is placed next to it
+    database_file = conn.execute("PRAGMA database_list").fetchone()[2]
+    return os.path.splitext(database_file)[0] + "_figure_cache.db"
+
+
+def connect_figure_cache(path):
+    connection = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+    # WAL lets the workers read while one of them writes
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA synchronous = NORMAL")
+    connection.execute("CREATE TABLE IF NOT EXISTS figure_cache (key TEXT PRIMARY KEY, function TEXT, "
+                       "build_id TEXT, value BLOB, size INTEGER, accessed REAL)")
+    connection.execute("CREATE INDEX IF NOT EXISTS figure_cache_accessed ON figure_cache (accessed)")
+    connection.execute("CREATE TABLE IF NOT EXISTS figure_cache_stats (function TEXT PRIMARY KEY, "
+                       "hits INTEGER DEFAULT 0, misses INTEGER DEFAULT 0)")
+    return connection
+
+
+def get_figure_cache_connection(path, build_id):
+    # Called with figure_cache_lock held
+    global figure_cache_pid
+    # Connections are not shared with forked worker processes
+    if figure_cache_pid != os.getpid():
+        figure_cache_pid = os.getpid()
+        figure_cache_connections.clear()
+        figure_cache_build_ids.clear()
+    if path not in figure_cache_connections:
+        figure_cache_connections[path] = connect_figure_cache(path)
+    cache_conn = figure_cache_connections[path]
+    if figure_cache_build_ids.get(path, figure_cache_absent) != build_id:
+        # At startup and after a rebuild of the database: entries of other builds are never used again
+        cache_conn.execute("DELETE FROM figure_cache WHERE build_id IS NOT ?", (build_id,))
+        figure_cache_build_ids[path] = build_id
+    return cache_conn
+
+
+def count_figure_cache(function, outcome):
+    # Called with figure_cache_lock held
+    figure_cache_stats[outcome] += 1
+    counts = figure_cache_pending["counts"].setdefault(function, {"hits": 0, "misses": 0})
+    counts[outcome] += 1
+
+
+def flush_figure_cache(cache_conn):
+    # Called with figure_cache_lock held, writes the pending access times and counts
+    pending = figure_cache_pending
+    if not pending["accessed"] and not pending["counts"]:
+        pending["since"] = time.monotonic()
+        return
+    cache_conn.execute("BEGIN IMMEDIATE")
+    try:
+        write_pending_figure_cache(cache_conn)
+        cache_conn.execute("COMMIT")
+    except sqlite3.Error:
+        cache_conn.execute("ROLLBACK")
+        raise
+
+
+def write_pending_figure_cache(cache_conn):
+    # Called in a write transaction
+    pending = figure_cache_pending
+    cache_conn.executemany("UPDATE figure_cache SET accessed = MAX(accessed, ?) WHERE key = ?",
+                           [(accessed, key) for key, accessed in pending["accessed"].items()])
+    for function, counts in pending["counts"].items():
+        cache_conn.execute("INSERT INTO figure_cache_stats (function, hits, misses) VALUES (?, ?, ?) "
+                           "ON CONFLICT(function) DO UPDATE SET hits = hits + excluded.hits, "
+                           "misses = misses + excluded.misses", (function, counts["hits"], counts["misses"]))
+    pending["accessed"], pending["counts"], pending["since"] = {}, {}, time.monotonic()
+
+
+def figure_cache_lookup(cache_conn, key, function, build_id):
+    # Called with figure_cache_lock held, only reads the cache file
+    row = cache_conn.execute("SELECT value FROM figure_cache WHERE key = ? AND build_id IS ?",
+                             (key, build_id)).fetchone()
+    if row is None:
+        count_figure_cache(function, "misses")
+        return figure_cache_absent
+    figure_cache_pending["accessed"][key] = time.time()
+    count_figure_cache(function, "hits")
+    if time.monotonic() - figure_cache_pending["since"] > figure_cache_flush_interval:
+        flush_figure_cache(cache_conn)
+    return row[0]
+
+
+def figure_cache_store(cache_conn, key, function, build_id, data):
+    # Called with figure_cache_lock held
+    cache_conn.execute("BEGIN IMMEDIATE")
+    try:
+        cache_conn.execute("INSERT OR REPLACE INTO figure_cache (key, function, build_id, value, size, accessed) "
+                           "VALUES (?, ?, ?, ?, ?, ?)", (key, function, build_id, data, len(data), time.time()))
+        write_pending_figure_cache(cache_conn)
+        evict_figure_cache(cache_conn, key)
+        cache_conn.execute("COMMIT")
+    except sqlite3.Error:
+        cache_conn.execute("ROLLBACK")
+        raise
+
+
+def evict_figure_cache(cache_conn, stored_key):
+    total = cache_conn.execute("SELECT COALESCE(SUM(size), 0) FROM figure_cache").fetchone()[0]
+    if total <= figure_cache_max_bytes:
+        return
+    # The entry just stored is kept, even if it alone is over the limit
+    for key, size in cache_conn.execute("SELECT key, size FROM figure_cache WHERE key != ? ORDER BY accessed",
+                                        (stored_key,)).fetchall():
+        if total <= figure_cache_max_bytes:
+            break
+        cache_conn.execute("DELETE FROM figure_cache WHERE key = ?", (key,))
+        total -= size
+
+
+def count_figure_cache_error(err, action):
+    print(f"The error '{err}' occurred while {action} the figure cache in cached")
+    with figure_cache_lock:
+        figure_cache_stats["errors"] += 1
+
+
+"""
+Get a value from the figure cache, or build and store it
+Errors of the cache are printed and the value is built without it.
+"""
+
+
+def cached(conn, function, build, input_taxon, temporal_input=None, filter_terms=None, filter_purpose=None,
+           filter_source=None, *extra):
+    key = figure_cache_key(function, input_taxon, temporal_input, filter_terms, filter_purpose, filter_source,
+                           *extra)
+    try:
+        path = figure_cache_path(conn)
+        build_id = figure_cache_build_id(conn)
+        with figure_cache_lock:
+            data = figure_cache_lookup(get_figure_cache_connection(path, build_id), key, function, build_id)
+        if data is not figure_cache_absent:
+            return pickle.loads(data)
+    except (sqlite3.Error, pickle.UnpicklingError, OSError) as err:
+        count_figure_cache_error(err, "reading")
+        return build()
+    # Concurrent misses of the same key in this process build the value once
+    value = db.coalesce(("figure", key), build, ttl=0)
+    try:
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with figure_cache_lock:
+            figure_cache_store(get_figure_cache_connection(path, build_id), key, function, build_id, data)
+    except (sqlite3.Error, pickle.PicklingError) as err:
+        count_figure_cache_error(err, "writing")
+    return value
+
+
+"""
+Hit rate of the figure cache
+Counts of this process, and the counts of all workers per function from the cache file.
+"""
+
+
+def figure_cache_info(conn):
+    path = figure_cache_path(conn)
+    build_id = figure_cache_build_id(conn)
+    with figure_cache_lock:
+        cache_conn = get_figure_cache_connection(path, build_id)
+        flush_figure_cache(cache_conn)
+        info = dict(figure_cache_stats)
+        info["entries"], info["bytes"] = cache_conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM figure_cache").fetchone()
+        rows = cache_conn.execute("SELECT function, hits, misses FROM figure_cache_stats").fetchall()
+    lookups = info["hits"] + info["misses"]
+    info["hit_rate"] = info["hits"] / lookups if lookups else 0.0
+    info["functions"] = {}
+    for function, hits, misses in rows:
+        info["functions"][function] = {"hits": hits, "misses": misses,
+                                       "hit_rate": hits / (hits + misses) if hits + misses else 0.0}
+    return info
+
+
+def clear_figure_cache(conn):
+    path = figure_cache_path(conn)
+    build_id = figure_cache_build_id(conn)
+    with figure_cache_lock:
+        cache_conn = get_figure_cache_connection(path, build_id)
+        cache_conn.execute("DELETE FROM figure_cache")
+        cache_conn.execute("DELETE FROM figure_cache_stats")
+        figure_cache_pending["accessed"], figure_cache_pending["counts"] = {}, {}
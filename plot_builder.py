@@ -1,18 +1,21 @@
-import pycountry
-import plotly.express as px
+import functools
 import plotly.graph_objects as go
 import pandas as pd
 import database_scripts as db
+import query_builder as qb
+import country_codes as cc
+import figure_cache as fc
 import sqlite3
-import json
-from urllib.request import urlopen
-import math
+import base64
+import os
+import multiprocessing
 from itertools import product
 import numpy as np
-import random
-from dash import Dash, html, dcc, ctx, dash_table
+from dash import Dash, html, dcc, ctx, dash_table, Patch
 import dash_bootstrap_components as dbc
 import time
+import threading
+from collections import OrderedDict
 
 # Colors
 lightblue = "#a6cee3"
@@ -46,6 +49,7 @@ color_dict = {
 
 color_discrete_sequence_list = [lightblue, blue, lightgreen, green, lightred, red, lightpurple, purple, orange]
 
+
 """
 Auxiliary functions
 """
@@ -72,47 +76,6 @@ null_graph = {
 }
 
 
-def convert_countrycode(value, input_type, output_type):
-    def result(co, output_type):
-        if output_type == "name":
-            return co.name
-        if output_type == "alpha_2":
-            return co.alpha_2
-        if output_type == "alpha_3":
-            return co.alpha_3
-
-    for co in list(pycountry.countries):
-        if input_type == "name":
-            if value in co.name:
-                return result(co, output_type)
-            try:
-                if value in co.official_name:
-                    return result(co, output_type)
-            except:
-                pass
-            value_alt = value.replace(" (", ", ")
-            value_alt = value_alt.replace(")", "")
-            if value_alt in co.name:
-                return result(co, output_type)
-        if input_type == "alpha_2":
-            if value in co.alpha_2:
-                return result(co, output_type)
-        if input_type == "alpha_3":
-            if value in co.alpha_3:
-                return result(co, output_type)
-    for co in list(pycountry.historic_countries):
-        if input_type == "name":
-            if value in co.name:
-                return result(co, output_type)
-        if input_type == "alpha_2":
-            if value in co.alpha_2:
-                return result(co, output_type)
-        if input_type == "alpha_3":
-            if value in co.alpha_3:
-                return result(co, output_type)
-    return value + "(Not Found)"
-
-
 """
 Create dictionaries for filters from database results
 """
@@ -185,219 +148,217 @@ null_graph = {
     }
 }
 
+"""
+Labels and categories of the line diagrams
+Source/Purpose codes -> labels and Term -> category. The lookups are applied to the categories of the
+categorical columns (a few values), the rows only take the resulting integer codes.
+"""
+
+source_labels = {"A": "Artificially propagated plants",
+                 "C": "Bred in captivity",
+                 "B": "Bred in captivity (Appx I)",
+                 "F": "Born in captivity",
+                 "I": "Confiscated specimens",
+                 "O": "Pre-Convention specimens",
+                 "R": "Ranched specimens",
+                 "U": "Source unknown",
+                 "W": "Taken from wild",
+                 "X": "Taken from marine env.",
+                 "Y": "Assisted production"}
+
+purpose_labels = {"B": "Breeding",
+                  "E": "Educational",
+                  "G": "Botanical garden",
+                  "H": "Hunting Trophy",
+                  "L": "Law enforcement",
+                  "M": "Medical",
+                  "N": "(Re)introduction",
+                  "P": "Personal",
+                  "Q": "Circus/Exhibition",
+                  "S": "Scientific",
+                  "T": "Commercial",
+                  "Z": "Zoo", }
+
+term_categories = {
+    "specimens": "Common Products",
+    "bodies": "Animalia Products",
+    "feet": "Animalia Products",
+    "cultures": "Common Products",
+    "meat": "Animalia Products",
+    "claws": "Animalia Products",
+    "tails": "Animalia Products",
+    "hair": "Animalia Products",
+    "ears": "Animalia Products",
+    "eggs": "Animalia Products",
+    "fins": "Animalia Products",
+    "fingerlings": "Animalia Products",
+    "genitalia": "Animalia Products",
+    "calipee": "Animalia Products",
+    "gall": "Animalia Products",
+    "gall bladders": "Animalia Products",
+    "heads": "Animalia Products",
+    "musk": "Animalia Products",
+    "swim bladders": "Animalia Products",
+    "frog legs": "Animalia Products",
+    "trunk": "Animalia Products",
+    "pupae": "Animalia Products",
+    "eggshell": "Animalia Products",
+    "sawfish rostrum": "Animalia Products",
+    "gill plates": "Animalia Products",
+    "eggs (live)": "Animalia Products",
+    "timber pieces": "Plantae Products",
+    "roots": "Plantae Products",
+    "leaves": "Plantae Products",
+    "timber": "Plantae Products",
+    "flowers": "Plantae Products",
+    "fruit": "Plantae Products",
+    "wax": "Plantae Products",
+    "stems": "Plantae Products",
+    "sawn wood": "Plantae Products",
+    "chips": "Plantae Products",
+    "graft rootstocks": "Plantae Products",
+    "logs": "Plantae Products",
+    "plywood": "Plantae Products",
+    "veneer": "Plantae Products",
+    "bark": "Plantae Products",
+    "kernel": "Plantae Products",
+    "transformed wood": "Plantae Products",
+    "seeds": "Plantae Products",
+    "oil": "Common Products",
+    "live": "Common Products",
+    "dried plants": "Common Products",
+    "raw corals": "Common Products",
+    "fibres": "Common Products",
+    "extract": "Common Products",
+    "caviar": "Common Products",
+    "coral sand": "Common Products",
+    "pearls": "Common Products",
+    "pearl": "Common Products",
+    "trophies": "Processed Products",
+    "leather items": "Processed Products",
+    "shoes": "Processed Products",
+    "leather products (small)": "Processed Products",
+    "leather": "Processed Products",
+    "carvings": "Processed Products",
+    "wood products": "Processed Products",
+    "garments": "Processed Products",
+    "horn products": "Processed Products",
+    "horn carvings": "Processed Products",
+    "ivory carvings": "Processed Products",
+    "soup": "Processed Products",
+    "timber carvings": "Processed Products",
+    "cloth": "Processed Products",
+    "powder": "Processed Products",
+    "medicine": "Processed Products",
+    "leather products (large)": "Processed Products",
+    "flower pots": "Processed Products",
+    "furniture": "Processed Products",
+    "hair products": "Processed Products",
+    "sets of piano keys": "Processed Products",
+    "quills": "Processed Products",
+    "spectacle frames": "Processed Products",
+    "jewellery - ivory ": "Processed Products",
+    "jewellery": "Processed Products",
+    "wood product": "Processed Products",
+    "rug": "Processed Products",
+    "cosmetics": "Processed Products",
+    "piano keys": "Processed Products",
+    "fur products (large)": "Processed Products",
+    "fur product (small)": "Processed Products",
+    "skeletons": "Bone",
+    "skulls": "Bone",
+    "bone products": "Bone",
+    "bones": "Bone",
+    "teeth": "Bone",
+    "tusks": "Bone",
+    "bone carvings": "Bone",
+    "horns": "Bone",
+    "shells": "Bone",
+    "bone pieces": "Bone",
+    "ivory scraps": "Bone",
+    "horn pieces": "Bone",
+    "ivory pieces": "Bone",
+    "horn scraps": "Bone",
+    "baleen": "Bone",
+    "skins": "Skin",
+    "feathers": "Skin",
+    "carapaces": "Skin",
+    "scales": "Skin",
+    "skin scraps": "Skin",
+    "plates": "Skin",
+    "skin pieces": "Skin",
+    "sides": "Skin",
+    "unspecified": "Others",
+    "derivatives": "Others",
+    "venom": "Others",
+    "scraps": "Others",
+}
+# Alphabetical, the order of the traces in the Term diagram
+term_category_list = sorted(set(term_categories.values()))
+
+
 """
 Build a line diagram of input data
 """
 
 
-def build_line_diagram(input_attribute, temporal_input, filter_terms, filter_purpose, filter_source, conn):
-    try:
-        sql_start = "SELECT {0}, Year, count({0}) FROM temp.taxon WHERE Year<={1} AND".format(input_attribute,
-                                                                                              temporal_input)
-        sql_purpose = "Purpose IN {0}".format(db.list_to_sql(filter_purpose))
-        sql_purpose_null = "OR Purpose IS NULL"
-        sql_source = "Source IN {0}".format(db.list_to_sql(filter_source))
-        sql_source_null = "OR Source IS NULL"
-        sql_term = "Term IN {0}".format(db.list_to_sql(filter_terms))
-        sql_term_null = "OR Term IS NULL"
-        sql_end = "GROUP BY {0}, Year ORDER BY Year, {0}".format(input_attribute)
-
-        if "Unknown" in filter_purpose:
-            sql = sql_start + " (" + sql_purpose + " " + sql_purpose_null + ")"
-        else:
-            sql = sql_start + " " + sql_purpose
-        if "Unknown" in filter_source:
-            sql = sql + " AND (" + sql_source + " " + sql_source_null + ")"
-        else:
-            sql = sql + " AND " + sql_source
-        if "Unknown" in filter_terms:
-            sql = sql + " AND (" + sql_term + " " + sql_term_null + ")"
-        else:
-            sql = sql + " AND " + sql_term
-        sql = sql + " " + sql_end
-        df = db.run_query(sql, conn)
-        df["count(" + input_attribute + ")"] = df["count(" + input_attribute + ")"].astype(int)
+def build_line_diagrams(input_taxon, temporal_input, filter_terms, filter_purpose, filter_source, conn):
+    # The total shipments badge is the sum of the Term diagram
+    data = db.get_data_line_diagrams(input_taxon, temporal_input, filter_terms, filter_purpose, filter_source, conn)
+    term_fig, total_shipments = build_line_diagram("Term", data["Term"])
+    source_fig = build_line_diagram("Source", data["Source"])[0]
+    purpose_fig = build_line_diagram("Purpose", data["Purpose"])[0]
+    return term_fig, total_shipments, source_fig, purpose_fig
 
-        if input_attribute == "Source":
-            df.fillna(value="Missing Data", axis="index", inplace=True)
-        if input_attribute == "Purpose":
-            df.fillna(value="Missing Data", axis="index", inplace=True)
-        if input_attribute == "Term":
-            df.fillna(value="Missing Data", axis="index", inplace=True)
-        df.rename(columns={"count(" + input_attribute + ")": "Count"}, inplace=True)
 
+def get_line_diagrams(input_taxon, temporal_input, filter_terms, filter_purpose, filter_source, conn):
+    return fc.cached(conn, "build_line_diagrams",
+                     lambda: build_line_diagrams(input_taxon, temporal_input, filter_terms, filter_purpose,
+                                                 filter_source, conn),
+                     input_taxon, temporal_input, filter_terms, filter_purpose, filter_source)
 
-    except sqlite3.Error as err:
-        print(f"The error '{err}' occurred while 'getting data from temp table' in build_line_diagram")
-
-    if input_attribute == "Source":
-        source_dict = {"A": "Artificially propagated plants",
-                       "C": "Bred in captivity",
-                       "B": "Bred in captivity (Appx I)",
-                       "F": "Born in captivity",
-                       "I": "Confiscated specimens",
-                       "O": "Pre-Convention specimens",
-                       "R": "Ranched specimens",
-                       "U": "Source unknown",
-                       "W": "Taken from wild",
-                       "X": "Taken from marine env.",
-                       "Y": "Assisted production"}
-        df.replace({"Source": source_dict}, inplace=True)
-
-    if input_attribute == "Purpose":
-        purpose_dict = {"B": "Breeding",
-                        "E": "Educational",
-                        "G": "Botanical garden",
-                        "H": "Hunting Trophy",
-                        "L": "Law enforcement",
-                        "M": "Medical",
-                        "N": "(Re)introduction",
-                        "P": "Personal",
-                        "Q": "Circus/Exhibition",
-                        "S": "Scientific",
-                        "T": "Commercial",
-                        "Z": "Zoo", }
-        df.replace({"Purpose": purpose_dict}, inplace=True)
 
+def build_line_diagram(input_attribute, df):
+    values = df[input_attribute].cat.categories
+    codes = df[input_attribute].cat.codes.to_numpy()
     if input_attribute == "Term":
-        term_dict = {
-                     "specimens": "Common Products",
-                     "bodies": "Animalia Products",
-                     "feet": "Animalia Products",
-                     "cultures": "Common Products",
-                     "meat": "Animalia Products",
-                     "claws": "Animalia Products",
-                     "tails": "Animalia Products",
-                     "hair": "Animalia Products",
-                     "ears": "Animalia Products",
-                     "eggs": "Animalia Products",
-                     "fins": "Animalia Products",
-                     "fingerlings": "Animalia Products",
-                     "genitalia": "Animalia Products",
-                     "calipee": "Animalia Products",
-                     "gall": "Animalia Products",
-                     "gall bladders": "Animalia Products",
-                     "heads": "Animalia Products",
-                     "musk": "Animalia Products",
-                     "swim bladders": "Animalia Products",
-                     "frog legs": "Animalia Products",
-                     "trunk": "Animalia Products",
-                     "pupae": "Animalia Products",
-                     "eggshell": "Animalia Products",
-                     "sawfish rostrum": "Animalia Products",
-                     "gill plates": "Animalia Products",
-                     "eggs (live)": "Animalia Products",
-                     "timber pieces": "Plantae Products",
-                     "roots": "Plantae Products",
-                     "leaves": "Plantae Products",
-                     "timber": "Plantae Products",
-                     "flowers": "Plantae Products",
-                     "fruit": "Plantae Products",
-                     "wax": "Plantae Products",
-                     "stems": "Plantae Products",
-                     "sawn wood": "Plantae Products",
-                     "chips": "Plantae Products",
-                     "graft rootstocks": "Plantae Products",
-                     "logs": "Plantae Products",
-                     "plywood": "Plantae Products",
-                     "veneer": "Plantae Products",
-                     "bark": "Plantae Products",
-                     "kernel": "Plantae Products",
-                     "transformed wood": "Plantae Products",
-                     "seeds": "Plantae Products",
-                     "oil": "Common Products",
-                     "live": "Common Products",
-                     "dried plants": "Common Products",
-                     "raw corals": "Common Products",
-                     "fibres": "Common Products",
-                     "extract": "Common Products",
-                     "caviar": "Common Products",
-                     "coral sand": "Common Products",
-                     "pearls": "Common Products",
-                     "pearl": "Common Products",
-                     "trophies": "Processed Products",
-                     "leather items": "Processed Products",
-                     "shoes": "Processed Products",
-                     "leather products (small)": "Processed Products",
-                     "leather": "Processed Products",
-                     "carvings": "Processed Products",
-                     "wood products": "Processed Products",
-                     "garments": "Processed Products",
-                     "horn products": "Processed Products",
-                     "horn carvings": "Processed Products",
-                     "ivory carvings": "Processed Products",
-                     "soup": "Processed Products",
-                     "timber carvings": "Processed Products",
-                     "cloth": "Processed Products",
-                     "powder": "Processed Products",
-                     "medicine": "Processed Products",
-                     "leather products (large)": "Processed Products",
-                     "flower pots": "Processed Products",
-                     "furniture": "Processed Products",
-                     "hair products": "Processed Products",
-                     "sets of piano keys": "Processed Products",
-                     "quills": "Processed Products",
-                     "spectacle frames": "Processed Products",
-                     "jewellery - ivory ": "Processed Products",
-                     "jewellery": "Processed Products",
-                     "wood product": "Processed Products",
-                     "rug": "Processed Products",
-                     "cosmetics": "Processed Products",
-                     "piano keys": "Processed Products",
-                     "fur products (large)": "Processed Products",
-                     "fur product (small)": "Processed Products",
-                     "skeletons": "Bone",
-                     "skulls": "Bone",
-                     "bone products": "Bone",
-                     "bones": "Bone",
-                     "teeth": "Bone",
-                     "tusks": "Bone",
-                     "bone carvings": "Bone",
-                     "horns": "Bone",
-                     "shells": "Bone",
-                     "bone pieces": "Bone",
-                     "ivory scraps": "Bone",
-                     "horn pieces": "Bone",
-                     "ivory pieces": "Bone",
-                     "horn scraps": "Bone",
-                     "baleen": "Bone",
-                     "skins": "Skin",
-                     "feathers": "Skin",
-                     "carapaces": "Skin",
-                     "scales": "Skin",
-                     "skin scraps": "Skin",
-                     "plates": "Skin",
-                     "skin pieces": "Skin",
-                     "sides": "Skin",
-                     "unspecified": "Others",
-                     "derivatives": "Others",
-                     "venom": "Others",
-                     "scraps": "Others",
-                     }
-        df["Category"] = df.loc[:, "Term"]
-        df.replace({"Category": term_dict}, inplace=True)
-        df["color_id"] = df.loc[:, "Category"]
-        category_list = ["Animalia Products", "Plantae Products", "Common Products", "Processed Products", "Bone", "Skin", "Others"]
+        # Terms without a category are counted as Others
+        labels = term_category_list
+        lookup = np.array([labels.index(term_categories.get(term, "Others")) for term in values], dtype=int)
         legend_names = {}
-        for category in category_list:
-            unique_terms = set(df.loc[df["Category"] == category, "Term"].tolist())
-            unique_string = {category : category + " (" + ", ".join(unique_terms) + ")"}
-            legend_names.update(unique_string)
-        df.drop(columns="Term", inplace=True)
-        df.rename(columns={"Category":"Term"}, inplace=True)
-        df = df.groupby(by=["Year", "Term", "color_id"], as_index=False)["Count"].sum()
+        present = np.unique(codes)
+        for category_code, category in enumerate(labels):
+            unique_terms = sorted(values[present[lookup[present] == category_code]])
+            legend_names[category] = category + " (" + ", ".join(unique_terms) + ")"
     else:
-        # Aggregate Misc
-        df_misc = df.copy()
-        df_misc = df_misc.groupby([input_attribute])["Count"].sum().sort_values(ascending=False)
-        top_result = df_misc.idxmax()
-        df_misc = df_misc.to_frame()
-        df_misc.reset_index(inplace=True)
-        df_misc = df_misc.loc[5:]
-        misc_list = df_misc[input_attribute].tolist()
-        misc_string = "Others (" + ", ".join(misc_list) + ")"
-        df.replace(to_replace=misc_list, value=misc_string, inplace=True)
-
+        value_labels = source_labels if input_attribute == "Source" else purpose_labels
+        mapped = [value_labels.get(value, value) for value in values]
+        labels = list(dict.fromkeys(mapped))
+        lookup = np.array([labels.index(label) for label in mapped], dtype=int)
+        # Aggregate Misc (everything but the five largest)
+        totals = np.bincount(lookup[codes], weights=df["Count"].to_numpy(), minlength=len(labels))
+        ranking = sorted(range(len(labels)), key=lambda x: (-totals[x], labels[x]))
+        misc = [x for x in ranking[5:] if totals[x] > 0]
+        if misc:
+            labels = labels + ["Others (" + ", ".join(labels[x] for x in misc) + ")"]
+            remap = np.arange(len(labels))
+            remap[misc] = len(labels) - 1
+            lookup = remap[lookup]
+            # Keep the order in which the labels first appear in the rows (Year, value)
+            first_row = np.full(len(labels), len(codes))
+            np.minimum.at(first_row, lookup[codes], np.arange(len(codes)))
+            order = np.argsort(first_row, kind="stable")
+            labels = [labels[x] for x in order]
+            lookup = np.argsort(order)[lookup]
+    counts = df.groupby([df["Year"].to_numpy(), lookup[codes]])["Count"].sum()
+    df = pd.DataFrame({
+        "Year": counts.index.get_level_values(0),
+        input_attribute: np.array(labels, dtype=object)[counts.index.get_level_values(1)],
+        "Count": counts.to_numpy(),
+    })
+
+    # Only imported when the first line diagram is built (startup time)
+    import plotly.express as px
     fig = go.Figure(layout=dict(template="plotly"))
     if input_attribute == "Term":
         fig = px.line(
@@ -473,114 +434,99 @@ def build_empty_map_graph():
     return fig_map
 
 
+"""
+Cached map layers
+The base map is built once per process. Data derived from the database, like the distribution
+layer (choropleth) of a taxon, is memoized in small LRU memos that are dropped when the database
+is rebuilt (see db.get_database_build_id).
+"""
+
+base_map_fig = None
+
+
+def create_memo(max_entries):
+    return {"entries": OrderedDict(), "lock": threading.Lock(), "build_id": None, "max_entries": max_entries}
+
+
+def memo_get(memo, key, conn, build):
+    build_id = db.get_database_build_id(conn)
+    with memo["lock"]:
+        if build_id != memo["build_id"]:
+            memo["entries"].clear()
+            memo["build_id"] = build_id
+        if key in memo["entries"]:
+            memo["entries"].move_to_end(key)
+            return memo["entries"][key]
+    # Concurrent misses of the same key build the value once
+    value = db.coalesce(("memo", id(memo), key), build, ttl=0)
+    with memo["lock"]:
+        memo["entries"][key] = value
+        while len(memo["entries"]) > memo["max_entries"]:
+            memo["entries"].popitem(last=False)
+    return value
+
+
+distribution_layers = create_memo(64)
+
+
+def get_base_map_graph():
+    global base_map_fig
+    if base_map_fig is None:
+        base_map_fig = build_empty_map_graph()
+    # Copy, the caller adds traces to the figure
+    return go.Figure(base_map_fig)
+
+
+def get_distribution_layer(input_taxon, conn):
+    return memo_get(distribution_layers, input_taxon, conn,
+                    lambda: fc.cached(conn, "build_distribution_layer",
+                                      lambda: build_distribution_layer(input_taxon, conn), input_taxon))
+
+
 """
 Add Distributions to map_graph
 """
 
 
 def add_distributions_to_map_graph(input_taxon, conn, map_fig):
-    sql = "SELECT * FROM species_plus WHERE \"Scientific Name\"=\"{0}\"".format(input_taxon)
-    df = db.run_query(sql, conn)
+    layer = get_distribution_layer(input_taxon, conn)
+    if layer is not None:
+        map_fig.add_trace(layer)
+    return map_fig
+
+
+"""
+Build the distribution layer (choropleth) of a taxon
+The distribution is read from species_distribution (long format, built with species_plus), where
+the ISO-3 codes and status codes (z) are already resolved.
+Returns None if the taxon has no distribution data.
+"""
+
+distribution_hover_colors = {0.5: "#fedfb7",  # Uncertain
+                             0.2: "#d8efc4",  # Reintroduced
+                             0.6: "#fdcccc",  # Possible Extinct
+                             0.7: "#eb5254",  # Extinct
+                             0.1: "#8cde87",  # Native
+                             0.3: "#b495d5",  # Introduced
+                             0.4: "#e4d8ea"}  # Possibly Introduced
+
+
+def build_distribution_layer(input_taxon, conn):
+    if not db.table_exists(conn, "species_distribution"):
+        print("The species distribution table is missing, please rebuild the Species+ database...")
+        return None
+    sql, params = qb.select("species_distribution", ["country", "alpha_3", "status", "status_code"],
+                            equals={"taxon": input_taxon}, order_by=("country", "alpha_3"))
+    df = db.run_query(sql, conn, params)
     if len(df) == 0:
-        # sql = "SELECT * FROM species_plus WHERE \"Listed under\"=\"{0}\"".format(input_taxon)
-        # df = db.run_query(sql, conn)
-        if len(df) == 0:
-            print("Unable to find species in Species+ database...")
-            return map_fig
-    df.drop(labels=["Scientific Name", "Listed under", "Listing", "Party", "Full note"], axis=1, inplace=True)
-    df.dropna(axis=1, inplace=True)
-    df = df.transpose()
-    df.reset_index(inplace=True)
-    df.rename(columns={"index": "Distribution", 0: "Country"}, inplace=True)
-    if len(df.Country.value_counts()) == 0:
-        print("No distribution data is available...")
-        return map_fig
-    df.set_index(["Distribution"])
-    df = df.apply(lambda x: x.str.split(",").explode())
-
-    def row_name_to_alpha3(row, col):
-        return convert_countrycode(row[col], "name", "alpha_3")
-
-    def distribution_to_color(row, col):
-        if row[col] == "Native_Distribution":
-            return 0.1
-        if row[col] == "Reintroduced_Distribution":
-            return 0.2
-        if row[col] == "Introduced_Distribution":
-            return 0.3
-        if row[col] == "Introduced(?)_Distribution":
-            return 0.4
-        if row[col] == "Distribution_Uncertain":
-            return 0.5
-        if row[col] == "Extinct(?)_Distribution":
-            return 0.6
-        if row[col] == "Extinct_Distribution":
-            return 0.7
-
-    def distribution_to_color_prioritized(row, col):
-        if "Uncertain" in row[col]:
-            return 0.5
-        if "Reintroduced" in row[col]:
-            return 0.2
-        if "Possibly Extinct" in row[col]:
-            return 0.6
-        if "Extinct" in row[col]:
-            return 0.7
-        if "Native" in row[col]:
-            return 0.1
-        if "Introduced" in row[col]:
-            return 0.3
-        if "Possibly Introduced" in row[col]:
-            return 0.4
-
-    def bgcolor_converter(row, col):
-        if row[col] == 0.5:  # Uncertain
-            return "#fedfb7"
-        if row[col] == 0.2:  # Reintroduced
-            return "#d8efc4"
-        if row[col] == 0.6:  # Possible Extinct
-            return "#fdcccc"
-        if row[col] == 0.7:  # Extinct
-            return "#eb5254"
-        if row[col] == 0.1:  # Native
-            return "#8cde87"
-        if row[col] == 0.3:  # Introduced
-            return "#b495d5"
-        if row[col] == 0.4:  # Possibly Introduced
-            return "#e4d8ea"
-
-    def text_generation(row, col):
-        if row[col] == "Native_Distribution":
-            return "Native"
-        if row[col] == "Reintroduced_Distribution":
-            return "Reintroduced"
-        if row[col] == "Introduced_Distribution":
-            return "Introduced"
-        if row[col] == "Introduced(?)_Distribution":
-            return "Possibly Introduced"
-        if row[col] == "Distribution_Uncertain":
-            return "Uncertain"
-        if row[col] == "Extinct(?)_Distribution":
-            return "Possibly Extinct"
-        if row[col] == "Extinct_Distribution":
-            return "Extinct"
-
-    def fix_reintro(row, col):
-        if "Reintro" in row[col]:
-            new_string = row[col].replace("Reintro", "Reintroduced")
-            return new_string
-
-    df["alpha_3"] = df.apply(lambda row: row_name_to_alpha3(row, "Country"), axis=1)
-    df["text"] = df.apply(lambda row: text_generation(row, "Distribution"), axis=1)
-    df = df.groupby(["Country", "alpha_3"])["text"].apply("<br> ".join).reset_index()
-    df["color_category"] = df.apply(lambda row: distribution_to_color_prioritized(row, "text"), axis=1)
-    df["hoverlabel_bgcolor"] = df.apply(lambda row: bgcolor_converter(row, "color_category"), axis=1)
-
-    map_fig.add_trace(go.Choropleth(
-        z=df["color_category"],
+        print("No distribution data is available in the Species+ database...")
+        return None
+
+    return go.Choropleth(
+        z=df["status_code"],
         locations=df["alpha_3"],
         locationmode="ISO-3",
-        text="<b>Country:</b> " + df["Country"] + "<br>" + "<b>Distribution Status (2022):</b><br> " + df["text"],
+        text="<b>Country:</b> " + df["country"] + "<br>" + "<b>Distribution Status (2022):</b><br> " + df["status"],
         hoverinfo="text",
         visible=True,
         zmin=0,
@@ -599,7 +545,7 @@ def add_distributions_to_map_graph(input_taxon, conn, map_fig):
             [1, "rgba(77,77,77,0)"],  # Dummy
         ],
         hoverlabel=dict(
-            bgcolor=df["hoverlabel_bgcolor"],
+            bgcolor=df["status_code"].map(distribution_hover_colors),
             bordercolor="black",
             font_color="black",
             font_size=12,
@@ -622,259 +568,249 @@ def add_distributions_to_map_graph(input_taxon, conn, map_fig):
         # ),
         # colorscale="Bluered",
         showscale=False,
-    ))
-    return map_fig
+    )
 
 
 """
-Update the map figure with traces
+Aggregate shipments into connections (Exporter -> Importer)
+The input has one row per shipment count (Year, Exporter, Importer, Count).
+Count, last shipment and opacity of every connection is calculated in one grouped pass.
+The opacity decreases by 0.05 for every year with trade after the last shipment of the connection.
 """
 
 
-def update_map_graph(temporal_input, filter_terms, filter_purpose, filter_source, conn, map_shipments_lower_tol,
-                     map_fig):
-    verbose = True
-    start = time.time()
-    # Setup dataframe and find connections to trace.
-    if verbose:
-        end = time.time()
-        elapsed_time = round(end - start, 0)
-    df = db.get_data_map_graph(temporal_input, filter_terms, filter_purpose, filter_source, conn)
+def opacity_decrease(x):
+    if x > 0.3:
+        return x - 0.05
+    else:
+        return 0.05
+
+
+def opacity_decay_table(steps):
+    # Opacity after n decreases, starting from a shipment (1.0)
+    table = [1.0]
+    for i in range(steps):
+        table.append(opacity_decrease(table[-1]))
+    return np.array(table)
+
+
+def connection_opacity(last_shipment, trade_years):
+    # Number of trade years after the last shipment of each connection
+    decay_steps = len(trade_years) - np.searchsorted(trade_years, last_shipment, side="right")
+    return opacity_decay_table(len(trade_years))[decay_steps]
+
+
+def aggregate_connections(df):
+    pairs = df.loc[:, ["Exporter", "Importer"]].drop_duplicates(inplace=False).reset_index(drop=True)
+    known = df.loc[(df["Importer"] != "Unknown") & (df["Exporter"] != "Unknown"),
+                   ["Exporter", "Importer", "Year", "Count"]]
+    trade_years = np.sort(known["Year"].unique())
+    yearly = known.groupby(["Exporter", "Importer", "Year"])["Count"].sum().rename("count").reset_index()
+    edges = yearly.groupby(["Exporter", "Importer"]).agg(count=("count", "sum"), last_shipment=("Year", "max"))
+    edges["opacity"] = connection_opacity(edges["last_shipment"].to_numpy(), trade_years)
+    shipment_traces = pairs.merge(edges.reset_index(), how="left", on=["Exporter", "Importer"])
+    # Connections with only unknown locations are never traded, but still decrease from 0
+    shipment_traces["count"] = shipment_traces["count"].fillna(0).astype(int)
+    shipment_traces["width"] = 0.0
+    shipment_traces["opacity"] = shipment_traces["opacity"].fillna(0.05 if len(trade_years) > 0 else 0.0)
+    shipment_traces["last_shipment"] = shipment_traces["last_shipment"].fillna(0).astype(int)
+    shipment_traces = shipment_traces.set_index(["Exporter", "Importer"])
+    shipment_traces = shipment_traces[["count", "width", "opacity", "last_shipment"]]
+    shipment_traces.sort_index(level=0, inplace=True)
+    return shipment_traces
+
+
+"""
+Calculate the midpoints of the connections
+Implementation of: http://www.movable-type.co.uk/scripts/latlong.html
+Takes arrays of coordinates in degrees, so all connections are calculated at once.
+"""
+
+
+def calculate_midpoints(exp_latitude, exp_longitude, imp_latitude, imp_longitude):
+    lat1, lon1 = np.radians(exp_latitude), np.radians(exp_longitude)
+    lat2, lon2 = np.radians(imp_latitude), np.radians(imp_longitude)
+    Bx = np.cos(lat2) * np.cos(lon2 - lon1)
+    By = np.cos(lat2) * np.sin(lon2 - lon1)
+    mid_latitude = np.arctan2(np.sin(lat1) + np.sin(lat2), np.sqrt((np.cos(lat1) + Bx) ** 2 + By ** 2))
+    mid_longitude = lon1 + np.arctan2(By, np.cos(lat1) + Bx)
+    return np.degrees(mid_latitude), np.degrees(mid_longitude)
+
+
+"""
+Spread overlapping midpoints
+Midpoints are hashed to a grid, and every point after the first in a grid cell is moved by a fixed
+offset (a ring of 8 directions, growing outwards). The same input always gives the same layout.
+"""
+
+midpoint_grid_size = 0.5
+midpoint_offset_distance = 3.5
+midpoint_offset_directions = np.radians(np.arange(45, 405, 45))
+
+
+def spread_midpoints(mid_latitude, mid_longitude):
+    # Countries without coordinates give NaN midpoints, they are not in any cell and stay NaN
+    finite = np.isfinite(mid_latitude) & np.isfinite(mid_longitude)
+    cells = pd.DataFrame({
+        "lat": np.floor(mid_latitude[finite] / midpoint_grid_size),
+        "lon": np.floor(mid_longitude[finite] / midpoint_grid_size),
+    })
+    # 0 for the first point in a cell, 1 for the second, etc.
+    rank = np.zeros(len(mid_latitude), dtype=int)
+    rank[finite] = cells.groupby(["lat", "lon"], sort=False).cumcount().to_numpy(dtype=int)
+    moved = rank > 0
+    step = rank[moved] - 1
+    distance = midpoint_offset_distance * (1 + step // len(midpoint_offset_directions))
+    direction = midpoint_offset_directions[step % len(midpoint_offset_directions)]
+    mid_latitude, mid_longitude = mid_latitude.copy(), mid_longitude.copy()
+    mid_latitude[moved] = np.clip(mid_latitude[moved] + distance * np.sin(direction), -90, 90)
+    mid_longitude[moved] = mid_longitude[moved] + distance * np.cos(direction)
+    return mid_latitude, mid_longitude
+
+
+"""
+Connection data for the shipment store
+The map traces are drawn in the browser (assets/map_clientside.js), so the lower tolerance
+slider can filter the connections without a server round trip.
+The store holds every connection of the taxon and filters (all years), so the connections do not
+move when the year changes. Only count, last shipment and opacity depend on the year. The opacity
+is calculated here (connection_opacity), the browser calculates the width from the counts.
+The static columns are packed as base64 encoded little endian arrays. Countries are dictionary
+encoded: Exporter/Importer are indexes into the country list, which holds the names and coordinates.
+The year dependent columns are plain lists, so a year step can patch them (connection_store_patch).
+"""
+
+
+def pack_column(values, dtype):
+    return base64.b64encode(np.ascontiguousarray(values, dtype=dtype).tobytes()).decode("ascii")
+
+
+def load_connection_shipments(input_taxon, filter_terms, filter_purpose, filter_source, conn):
+    df = db.get_data_map_graph(input_taxon, None, filter_terms, filter_purpose, filter_source, conn)
     df.fillna(value="Unknown", axis="index", inplace=True)
     df.replace("XX", "Unknown", inplace=True)
-    df2 = df.loc[:, ["Exporter", "Importer"]].drop_duplicates(inplace=False).reset_index(drop=True)
-    df2["count"], df2["width"], df2["opacity"], df2["last_shipment"] = 0, 0.0, 0.0, 0
-    shipment_traces = df2.set_index(["Exporter", "Importer"])
-    shipment_traces.sort_index(level=0, inplace=True)
+    return df[(df["Importer"] != "Unknown") & (df["Exporter"] != "Unknown")]
 
-    # Calculate styling of connections
-    def opacity_decrease(x):
-        if x > 0.3:
-            return x - 0.05
-        else:
-            return 0.05
-
-    if verbose:
-        end = time.time()
-        elapsed_time = round(end - start, 0)
-    current_year = 0
-    Unknown_locations = 0
-    for index, row in df.iterrows():
-        if row["Importer"] != "Unknown" and row["Exporter"] != "Unknown":
-            if current_year != row["Year"]:
-                current_year = row["Year"]
-                shipment_traces["opacity"] = shipment_traces["opacity"].apply(lambda x: opacity_decrease(x))
-            shipment_traces.replace({"United States": "USA", "US": "USA"}, inplace=True)
-            shipment_traces.loc[(row["Exporter"], row["Importer"]), ["count"]] += 1
-            shipment_traces.loc[(row["Exporter"], row["Importer"]), ["opacity"]] = 1.0
-            shipment_traces.loc[(row["Exporter"], row["Importer"]), ["last_shipment"]] = current_year
-        else:
-            Unknown_locations += 1
-    if verbose:
-        end = time.time()
-        elapsed_time = round(end - start, 0)
-    shipment_traces = shipment_traces[~(shipment_traces["count"] <= map_shipments_lower_tol)]
-    shipment_traces = shipment_traces.reset_index()
-    count_max = shipment_traces.loc[shipment_traces["count"].idxmax()].values[2]
-    count_min = shipment_traces.loc[shipment_traces["count"].idxmin()].values[2]
-    def width_percentage(n, count_max, count_min):
-        return round(((n - count_min)/(count_max - count_min))*10, 2)
-    shipment_traces["width"] = shipment_traces["count"].apply(lambda x: width_percentage(x, count_max, count_min))
-    shipment_traces["width"].clip(lower=1, upper=10, axis=0, inplace=True)
-    shipment_traces["mid_latitude"], shipment_traces["mid_longitude"] = 0.0, 0.0
-    if verbose:
-        end = time.time()
-        elapsed_time = round(end - start, 0)
-
-    def calculate_midpoint(row):
-        # Python Implementatino of: http://www.movable-type.co.uk/scripts/latlong.html
-        def to_radians(val):
-            return val * math.pi / 180
-
-        def to_degress(val):
-            return val * 180 / math.pi
-
-        lat1 = to_radians(row["exp_latitude"])
-        lon1 = to_radians(row["exp_longitude"])
-        lat2 = to_radians(row["imp_latitude"])
-        lon2 = to_radians(row["imp_longitude"])
-        Bx = math.cos(lat2) * math.cos(lon2 - lon1)
-        By = math.cos(lat2) * math.sin(lon2 - lon1)
-        row["mid_latitude"] = to_degress(math.atan2(math.sin(lat1) + math.sin(lat2),
-                                                    math.sqrt((math.cos(lat1) + Bx) * (math.cos(lat1) + Bx) + By * By)))
-        row["mid_longitude"] = to_degress(lon1 + math.atan2(By, math.cos(lat1) + Bx))
-        return row
-
-    def row_alpha2_to_name(row, col):
-        return convert_countrycode(row[col], "alpha_2", "name")
-
-    shipment_traces["Importer_full"] = shipment_traces.apply(lambda row: row_alpha2_to_name(row, "Importer"), axis=1)
-    shipment_traces["Exporter_full"] = shipment_traces.apply(lambda row: row_alpha2_to_name(row, "Exporter"), axis=1)
-    if verbose:
-        end = time.time()
-        elapsed_time = round(end - start, 0)
-    historic_ISO_dict = {"AN": "BQ",
-                         "CS": "RS",
-                         "DD": "DE",
-                         "NT": "IQ",
-                         "PC": "FM",
-                         "XA": "Unknown",
-                         "XC": "Unknown",
-                         "XE": "Unknown",
-                         "XF": "Unknown",
-                         "XM": "Unknown",
-                         "XS": "Unknown",
-                         "YU": "HR",
-                         "ZC": "Unknown",
-                         "ZZ": "Unknown",
-                         }
-    shipment_traces.replace({"Exporter": historic_ISO_dict}, inplace=True)
-    shipment_traces.replace({"Importer": historic_ISO_dict}, inplace=True)
-
-    # Adding Latitude/Longitude to Importer, Exporter & Midpoint
-
-    json_file = "https://raw.githubusercontent.com/eesur/country-codes-lat-long/master/country-codes-lat-long-alpha3.json"
-    with urlopen(json_file) as response:
-        countries_json = json.load(response)
-    countries_json = pd.DataFrame(countries_json["ref_country_codes"])
-    if verbose:
-        end = time.time()
-        elapsed_time = round(end - start, 0)
-    shipment_traces = shipment_traces.merge(countries_json[["latitude", "longitude", "alpha2"]], how="left",
-                                            left_on="Importer", right_on="alpha2").drop(columns=["alpha2"]).rename(
-        columns={"latitude": "imp_latitude", "longitude": "imp_longitude"})
-
-    shipment_traces = shipment_traces.merge(countries_json[["latitude", "longitude", "alpha2"]], how="left",
-                                            left_on="Exporter", right_on="alpha2").drop(columns=["alpha2"]).rename(
-        columns={"latitude": "exp_latitude", "longitude": "exp_longitude"})
-
-    shipment_traces = shipment_traces.apply(lambda row: calculate_midpoint(row), axis=1)
-
-    shipment_traces["description"] = "<b>Exporter</b>: " + shipment_traces["Exporter_full"] + "<br>" + \
-                                     "<b>Importer</b>: " + shipment_traces["Importer_full"] + "<br>" + \
-                                     "——————————" + "<br>" \
-                                                    "<b># Trades</b>: " + shipment_traces["count"].astype(
-        str) + "<br>" + \
-                                     "<b>Last Trade</b>: " + shipment_traces["last_shipment"].astype(str)
-    shipment_traces.drop(["last_shipment"], axis=1)
-
-    # Look for duplicate midpoints and move them slightly if found.
-
-    def move_midpoint(row):
-        row["mid_latitude"] = row["mid_latitude"] + random.uniform(3.0, 4.0)
-        row["mid_longitude"] = row["mid_longitude"] + random.uniform(3.0, 4.0)
-        return row
-
-    if verbose:
-        end = time.time()
-        elapsed_time = round(end - start, 0)
-    rows_series = shipment_traces[["mid_latitude", "mid_longitude"]].duplicated(keep="first")
-    rows = rows_series[rows_series].index.values
-    shipment_traces = shipment_traces.apply(
-        lambda row: (move_midpoint(row) if row.name in rows else row), axis=1)
-    if verbose:
-        end = time.time()
-        elapsed_time = round(end - start, 0)
-    # Add traces to map figure
-    for i in range(len(shipment_traces)):
-        exp_lat, exp_lon = shipment_traces["exp_latitude"][i], shipment_traces["exp_longitude"][i]
-        mid_lat, mid_lon = shipment_traces["mid_latitude"][i], shipment_traces["mid_longitude"][i]
-        imp_lat, imp_lon = shipment_traces["imp_latitude"][i], shipment_traces["imp_longitude"][i]
-        map_fig.add_trace(
-            go.Scattergeo(
-                lat=([exp_lat, mid_lat, imp_lat]),
-                lon=([exp_lon, mid_lon, imp_lon]),
-                mode="lines",
-                hoverinfo="skip",
-                line=dict(
-                    width=shipment_traces["width"][i],
-                    color="rgba(31, 120, 180, {})".format(shipment_traces["opacity"][i]))
-            )),
-    # Info Dot
-    map_fig.add_trace(
-        go.Scattergeo(
-            lat=shipment_traces["mid_latitude"],
-            lon=shipment_traces["mid_longitude"],
-            text=shipment_traces["description"],
-            mode="markers",
-            hoverinfo="text",
-            marker=dict(
-                size=12,
-                symbol="circle",
-                opacity=shipment_traces["opacity"],
-                cauto=False,
-                color="#12476b",
-                line=dict(
-                    width=2,
-                    color="#1f78b4"
-                ),
-            ),
-            hoverlabel=dict(
-                bgcolor="#6695b4",
-                bordercolor="#1f78b4",
-                font_color="black",
-                font_size=12,
-                font_family="Verdana",
-                align="left",
-            )
 
-        )),
-    return map_fig, shipment_traces
-
-
-def map_tolerance_update(map_fig, shipment_traces, map_shipments_lower_tol):
-    shipment_traces = shipment_traces[~(shipment_traces["count"] <= map_shipments_lower_tol)]
-    shipment_traces = shipment_traces.reset_index()
-    # Add traces to map figure
-    for i in range(len(shipment_traces)):
-        exp_lat, exp_lon = shipment_traces["exp_latitude"][i], shipment_traces["exp_longitude"][i]
-        mid_lat, mid_lon = shipment_traces["mid_latitude"][i], shipment_traces["mid_longitude"][i]
-        imp_lat, imp_lon = shipment_traces["imp_latitude"][i], shipment_traces["imp_longitude"][i]
-        map_fig.add_trace(
-            go.Scattergeo(
-                lat=([exp_lat, mid_lat, imp_lat]),
-                lon=([exp_lon, mid_lon, imp_lon]),
-                mode="lines",
-                hoverinfo="skip",
-                line=dict(
-                    width=shipment_traces["width"][i],
-                    color="rgba(31, 120, 180, {})".format(shipment_traces["opacity"][i]))
-            )),
-    # Info Dot
-    map_fig.add_trace(
-        go.Scattergeo(
-            lat=shipment_traces["mid_latitude"],
-            lon=shipment_traces["mid_longitude"],
-            text=shipment_traces["description"],
-            mode="markers",
-            hoverinfo="text",
-            marker=dict(
-                size=12,
-                symbol="circle",
-                opacity=shipment_traces["opacity"],
-                cauto=False,
-                color="#12476b",
-                line=dict(
-                    width=2,
-                    color="#1f78b4"
-                ),
-            ),
-            hoverlabel=dict(
-                bgcolor="#6695b4",
-                bordercolor="#1f78b4",
-                font_color="black",
-                font_size=12,
-                font_family="Verdana",
-                align="left",
-            )
+"""
+Connection timeline
+The state of every connection of a taxon and filters after every trade year, calculated once by a
+sweep over the sorted years: cumulative count and last shipment per connection (the opacity follows
+from the last shipment and the trade years). The connections and their midpoints are part of the
+timeline as well. A year (frame) of the timeline is then served from memory, which is what stepping
+or playing the years on the map does.
+"""
 
-        )),
-    return map_fig
+connection_timelines = create_memo(16)
+
+
+def build_connection_timeline(input_taxon, filter_terms, filter_purpose, filter_source, conn):
+    df = load_connection_shipments(input_taxon, filter_terms, filter_purpose, filter_source, conn)
+    pairs = df[["Exporter", "Importer"]].drop_duplicates().sort_values(["Exporter", "Importer"])
+    pairs = pairs.reset_index(drop=True)
+    pair_codes = pd.MultiIndex.from_frame(pairs).get_indexer(pd.MultiIndex.from_frame(df[["Exporter", "Importer"]]))
+    years, year_codes = np.unique(df["Year"].to_numpy(), return_inverse=True)
+    traded = np.zeros((len(years), len(pairs)), dtype=np.int32)
+    np.add.at(traded, (year_codes, pair_codes), df["Count"].to_numpy())
+    mid_latitude, mid_longitude = calculate_midpoints(
+        pairs["Exporter"].map(cc.country_registry["latitude"]).to_numpy(dtype=float),
+        pairs["Exporter"].map(cc.country_registry["longitude"]).to_numpy(dtype=float),
+        pairs["Importer"].map(cc.country_registry["latitude"]).to_numpy(dtype=float),
+        pairs["Importer"].map(cc.country_registry["longitude"]).to_numpy(dtype=float))
+    mid_latitude, mid_longitude = spread_midpoints(mid_latitude, mid_longitude)
+    return {
+        "pairs": pairs,
+        "mid_latitude": mid_latitude,
+        "mid_longitude": mid_longitude,
+        "years": years,
+        "count": np.cumsum(traded, axis=0),
+        "last_shipment": np.maximum.accumulate(np.where(traded > 0, years[:, None], 0), axis=0).astype(np.int16),
+    }
+
+
+def get_connection_timeline(input_taxon, filter_terms, filter_purpose, filter_source, conn):
+    # Filter order does not matter, like the keys of the figure cache
+    key = (input_taxon, fc.normalize_filters(filter_terms), fc.normalize_filters(filter_purpose),
+           fc.normalize_filters(filter_source))
+    return memo_get(connection_timelines, key, conn, lambda: build_connection_timeline(
+        input_taxon, filter_terms, filter_purpose, filter_source, conn))
+
+
+def connection_timeline_frame(timeline, temporal_input):
+    # Count, last shipment and trade years of every connection up to (and including) the year
+    frame = np.searchsorted(timeline["years"], int(temporal_input), side="right")
+    if frame == 0:
+        empty = np.zeros(len(timeline["pairs"]), dtype=int)
+        return empty, empty, timeline["years"][:0]
+    return timeline["count"][frame - 1], timeline["last_shipment"][frame - 1], timeline["years"][:frame]
+
+
+def connection_store_columns(timeline, temporal_input):
+    # The year dependent columns of the store
+    count, last_shipment, trade_years = connection_timeline_frame(timeline, temporal_input)
+    return {
+        "count": count,
+        "last_shipment": last_shipment,
+        "opacity": np.round(connection_opacity(last_shipment, trade_years), 2),
+    }
+
+
+def connection_store_data(input_taxon, temporal_input, filter_terms, filter_purpose, filter_source, conn):
+    timeline = get_connection_timeline(input_taxon, filter_terms, filter_purpose, filter_source, conn)
+    pairs = timeline["pairs"]
+    countries = pd.Index(pd.concat([pairs["Exporter"], pairs["Importer"]]).unique())
+    coordinates = cc.country_registry.reindex(countries)
+    return {
+        "rows": len(pairs),
+        "countries": {
+            "name": cc.convert_countrycode_column(pd.Series(countries), "alpha_2", "name").tolist(),
+            "latitude": pack_column(coordinates["latitude"], "<f4"),
+            "longitude": pack_column(coordinates["longitude"], "<f4"),
+        },
+        "exporter": pack_column(countries.get_indexer(pairs["Exporter"]), "<u2"),
+        "importer": pack_column(countries.get_indexer(pairs["Importer"]), "<u2"),
+        "mid_latitude": pack_column(timeline["mid_latitude"], "<f4"),
+        "mid_longitude": pack_column(timeline["mid_longitude"], "<f4"),
+        **{column: values.tolist() for column, values in connection_store_columns(timeline, temporal_input).items()},
+    }
+
+
+def get_connection_store_data(input_taxon, temporal_input, filter_terms, filter_purpose, filter_source, conn):
+    return fc.cached(conn, "connection_store_data",
+                     lambda: connection_store_data(input_taxon, temporal_input, filter_terms, filter_purpose,
+                                                   filter_source, conn),
+                     input_taxon, temporal_input, filter_terms, filter_purpose, filter_source)
+
+
+"""
+Patch the shipment store for a new year
+Shipments up to year N are a subset of the shipments up to year N + 1, so the connections of the
+store stay the same and only the counts and last shipments of connections traded in between change.
+The opacity of the other connections decreases when a year with trade is added.
+Only the changed items are sent to the browser (Dash Patch), or the whole list of a column if that is
+smaller.
+"""
+
+
+def connection_store_patch(input_taxon, previous_year, temporal_input, filter_terms, filter_purpose, filter_source,
+                           conn):
+    timeline = get_connection_timeline(input_taxon, filter_terms, filter_purpose, filter_source, conn)
+    previous_columns = connection_store_columns(timeline, previous_year)
+    patch = Patch()
+    for column, values in connection_store_columns(timeline, temporal_input).items():
+        changed = np.flatnonzero(previous_columns[column] != values)
+        # An assignment costs about as much as 20 list items
+        if len(changed) * 20 > len(values):
+            patch[column] = values.tolist()
+        else:
+            for i in changed.tolist():
+                patch[column][i] = values[i].item()
+    return patch
 
 
 def history_listing_generator(input_taxon, conn):
-    sql = "SELECT * FROM history_listings WHERE FullName=\"{}\"".format(input_taxon)
-    df = db.run_query(sql, conn)
+    sql, params = qb.select("history_listings", equals={"FullName": input_taxon})
+    df = db.run_query(sql, conn, params)
     if df.empty:
         print("No data found in History Listings")
         return "No Data in History Listings."
@@ -937,3 +873,51 @@ def history_listing_generator(input_taxon, conn):
             hover=False,
         )
     return table
+
+
+def get_history_listing(input_taxon, conn):
+    return fc.cached(conn, "history_listing_generator", lambda: history_listing_generator(input_taxon, conn),
+                     input_taxon)
+
+
+"""
+Warm up the caches
+Renders the default view of the most traded taxa, as the app shows it after a taxon is selected:
+latest year and all filters (history listing, line diagrams, distribution layer and shipment store;
+the tolerance filters the store in the browser). The results are written to the figure cache, which
+the workers of the app share, so the first request of these taxa after a deploy is a cache hit.
+"""
+
+
+def warm_up_taxon(database, input_taxon):
+    start = time.time()
+    try:
+        with db.read_connection(database) as conn:
+            taxon_data = db.get_taxon_data(input_taxon, conn)
+            temporal_input = int(taxon_data["Year"].max())
+            filter_terms = db.get_unique_values(input_taxon, "Term", conn)
+            filter_purpose = sorted(db.get_unique_values(input_taxon, "Purpose", conn))
+            filter_source = sorted(db.get_unique_values(input_taxon, "Source", conn))
+            get_history_listing(input_taxon, conn)
+            get_line_diagrams(input_taxon, temporal_input, filter_terms, filter_purpose, filter_source, conn)
+            get_distribution_layer(input_taxon, conn)
+            get_connection_store_data(input_taxon, temporal_input, filter_terms, filter_purpose, filter_source, conn)
+    except sqlite3.Error as err:
+        print(f"The error '{err}' occurred while warming up {input_taxon}")
+    except Exception as err:
+        print(f"The error '{err}' occurred while warming up {input_taxon}, stopping the warm up")
+        raise
+    return input_taxon, time.time() - start
+
+
+def warm_up_caches(database, top_n=50, processes=None):
+    conn = db.connect_sqlite3_readonly(database)
+    taxa = db.get_top_taxa(conn, top_n)
+    conn.close()
+    processes = processes or max(1, min(len(taxa), (os.cpu_count() or 2) - 1))
+    start = time.time()
+    with multiprocessing.Pool(processes) as pool:
+        for i, (input_taxon, elapsed) in enumerate(
+                pool.imap_unordered(functools.partial(warm_up_taxon, database), taxa), start=1):
+            print(f"Warmed up {input_taxon} ({i}/{len(taxa)}) in {elapsed:.1f} secs")
+    print(f"Finished warming up {len(taxa)} taxa! Elapsed time: {time.time() - start:.1f} secs")
@@ -0,0 +1,44 @@
+import functools
+import json
+
+"""
+Parameterized query builder
+Values are always passed as parameters, never formatted into the SQL text. Lists are passed as one
+JSON parameter and expanded with json_each, so an IN-list has the same SQL text for any number of
+values. The same query shape therefore gives the same SQL text, which SQLite can take from the
+prepared statement cache of the connection.
+"""
+
+
+def quote_identifier(identifier):
+    return "\"{0}\"".format(identifier.replace("\"", "\"\""))
+
+
+@functools.lru_cache(maxsize=256)
+def build_select(table, columns, equals_columns=(), in_columns=(), group_by=(), order_by=()):
+    sql = "SELECT {0} FROM {1}".format(", ".join(columns), table)
+    conditions = ["{0}=?".format(quote_identifier(column)) for column in equals_columns]
+    conditions += ["{0} IN (SELECT value FROM json_each(?))".format(quote_identifier(column))
+                   for column in in_columns]
+    if conditions:
+        sql = sql + " WHERE " + " AND ".join(conditions)
+    if group_by:
+        sql = sql + " GROUP BY " + ", ".join(group_by)
+    if order_by:
+        sql = sql + " ORDER BY " + ", ".join(quote_identifier(column) for column in order_by)
+    return sql
+
+
+def select(table, columns=("*",), equals=None, in_lists=None, group_by=(), order_by=()):
+    # Returns the SQL text and its parameters.
+    # Columns and group_by are SQL expressions, filters and order_by are column names.
+    equals = equals or {}
+    in_lists = in_lists or {}
+    sql = build_select(table, tuple(columns), tuple(equals), tuple(in_lists), tuple(group_by), tuple(order_by))
+    params = list(equals.values()) + [json.dumps([value for value in values if value is not None])
+                                      for values in in_lists.values()]
+    return sql, params
+
+
+def statement_cache_info():
+    return build_select.cache_info()
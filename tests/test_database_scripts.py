@@ -0,0 +1,273 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import pytest
+import database_scripts as db
+
+"""
+Import manifest
+"""
+
+
+def write_csv(path, rows):
+    with open(path, "w") as f:
+        f.write("Year,Taxon\n")
+        for year, taxon in rows:
+            f.write("{0},{1}\n".format(year, taxon))
+    return str(path)
+
+
+def import_files(conn, csv_files):
+    entries, removed = db.compare_manifest(conn, csv_files)
+    db.remove_file_rows(conn, "shipments", entries + removed)
+    if entries:
+        db.ingest_csv_files(conn, "shipments", entries, {"Year": "int", "Taxon": "str"}, processes=1)
+    return entries, removed
+
+
+def manifest_fixture(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "cites.db"))
+    conn.execute("CREATE TABLE shipments (Year INTEGER, Taxon TEXT NOT NULL)")
+    db.create_manifest_table(conn)
+    return conn
+
+
+def shipment_rows(conn):
+    return sorted(conn.execute("SELECT Year, Taxon FROM shipments").fetchall())
+
+
+def manifest_status(conn):
+    return dict(conn.execute("SELECT file, status FROM import_manifest").fetchall())
+
+
+def test_failed_file_stays_importing(tmp_path):
+    conn = manifest_fixture(tmp_path)
+    a = write_csv(tmp_path / "a.csv", [(2000, "x")])
+    # Taxon is NOT NULL, the chunk of this file can not be written
+    b = write_csv(tmp_path / "b.csv", [(2001, "")])
+    import_files(conn, [a, b])
+    assert manifest_status(conn) == {"a.csv": "complete", "b.csv": "importing"}
+    write_csv(tmp_path / "b.csv", [(2001, "y")])
+    entries, _ = import_files(conn, [a, b])
+    assert [entry["file"] for entry in entries] == ["b.csv"]
+    assert shipment_rows(conn) == [(2000, "x"), (2001, "y")]
+
+
+def test_unchanged_files_are_skipped(tmp_path):
+    conn = manifest_fixture(tmp_path)
+    a = write_csv(tmp_path / "a.csv", [(2000, "x"), (2001, "y")])
+    b = write_csv(tmp_path / "b.csv", [(2002, "z")])
+    entries, _ = import_files(conn, [a, b])
+    assert [entry["slot"] for entry in entries] == [1, 2]
+    assert shipment_rows(conn) == [(2000, "x"), (2001, "y"), (2002, "z")]
+    # Touched, but with the same content
+    os.utime(a, (0, 0))
+    entries, removed = import_files(conn, [a, b])
+    assert entries == [] and removed == []
+    assert shipment_rows(conn) == [(2000, "x"), (2001, "y"), (2002, "z")]
+
+
+def test_changed_file_replaces_its_rows(tmp_path):
+    conn = manifest_fixture(tmp_path)
+    a = write_csv(tmp_path / "a.csv", [(2000, "x"), (2001, "y")])
+    b = write_csv(tmp_path / "b.csv", [(2002, "z")])
+    import_files(conn, [a, b])
+    write_csv(tmp_path / "a.csv", [(2005, "w")])
+    entries, _ = import_files(conn, [a, b])
+    assert [(entry["file"], entry["slot"]) for entry in entries] == [("a.csv", 1)]
+    assert shipment_rows(conn) == [(2002, "z"), (2005, "w")]
+
+
+def test_removed_file_deletes_its_rows(tmp_path):
+    conn = manifest_fixture(tmp_path)
+    a = write_csv(tmp_path / "a.csv", [(2000, "x")])
+    b = write_csv(tmp_path / "b.csv", [(2002, "z")])
+    import_files(conn, [a, b])
+    _, removed = import_files(conn, [b])
+    assert [entry["file"] for entry in removed] == ["a.csv"]
+    assert shipment_rows(conn) == [(2002, "z")]
+    assert manifest_status(conn) == {"b.csv": "complete"}
+
+
+def test_interrupted_file_is_imported_again(tmp_path):
+    conn = manifest_fixture(tmp_path)
+    a = write_csv(tmp_path / "a.csv", [(2000, "x")])
+    import_files(conn, [a])
+    conn.execute("UPDATE import_manifest SET status='importing'")
+    conn.commit()
+    entries, _ = import_files(conn, [a])
+    assert [entry["file"] for entry in entries] == ["a.csv"]
+    assert shipment_rows(conn) == [(2000, "x")]
+    assert manifest_status(conn) == {"a.csv": "complete"}
+
+
+def test_shipments_without_manifest_are_dropped(tmp_path):
+    conn = manifest_fixture(tmp_path)
+    # Imported without a manifest, rowids 1..N
+    conn.execute("INSERT INTO shipments VALUES (2000, 'x')")
+    conn.commit()
+    db.reset_untracked_shipments(conn, "shipments")
+    assert not db.table_exists(conn, "shipments")
+
+
+def test_shipments_with_manifest_are_kept(tmp_path):
+    conn = manifest_fixture(tmp_path)
+    import_files(conn, [write_csv(tmp_path / "a.csv", [(2000, "x")])])
+    db.reset_untracked_shipments(conn, "shipments")
+    assert shipment_rows(conn) == [(2000, "x")]
+    assert manifest_status(conn) == {"a.csv": "complete"}
+
+
+def test_columns_are_matched_by_name(tmp_path):
+    conn = manifest_fixture(tmp_path)
+    a = tmp_path / "a.csv"
+    a.write_text("Taxon,Year\nx,2000\ny,2001\n")
+    import_files(conn, [str(a)])
+    assert shipment_rows(conn) == [(2000, "x"), (2001, "y")]
+    assert conn.execute("SELECT DISTINCT typeof(Year) FROM shipments").fetchall() == [("integer",)]
+
+
+def test_file_with_missing_column_stays_importing(tmp_path):
+    conn = manifest_fixture(tmp_path)
+    a = tmp_path / "a.csv"
+    a.write_text("Year\n2000\n")
+    import_files(conn, [str(a)])
+    assert shipment_rows(conn) == []
+    assert manifest_status(conn) == {"a.csv": "importing"}
+
+
+"""
+Taxon cache
+"""
+
+
+def add_shipments(conn, year, rows):
+    conn.executemany("INSERT INTO shipments VALUES ('Psittacus erithacus', ?, 'live', 'T', 'W', 'DE', 'FR')",
+                     [(year,)] * rows)
+    conn.commit()
+
+
+def test_rebuild_drops_cached_taxon_data(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "cites.db"), check_same_thread=False)
+    conn.execute("CREATE TABLE shipments (Taxon TEXT, Year INTEGER, Term TEXT, Purpose TEXT, Source TEXT, "
+                 "Exporter TEXT, Importer TEXT)")
+    add_shipments(conn, 2020, 3)
+    db.mark_database_build(conn)
+    df = db.get_taxon_data("Psittacus erithacus", conn)
+    assert df["Count"].sum() == 3
+    filtered = db.get_filtered_taxon_data("Psittacus erithacus", None, ["live"], ["T"], ["W"], conn)
+    assert filtered["Count"].sum() == 3
+    add_shipments(conn, 2021, 2)
+    # Same build, the cached data is served
+    assert db.get_taxon_data("Psittacus erithacus", conn) is df
+    db.mark_database_build(conn)
+    df = db.get_taxon_data("Psittacus erithacus", conn)
+    assert (df["Count"].sum(), df["Year"].max()) == (5, 2021)
+    filtered = db.get_filtered_taxon_data("Psittacus erithacus", None, ["live"], ["T"], ["W"], conn)
+    assert filtered["Count"].sum() == 5
+
+
+"""
+Species search
+"""
+
+
+def species_index_fixture():
+    # In dropdown order: most entries first
+    dropdown = [{"value": name, "label": name} for name in
+                ["Psittacus erithacus", "Crocodylus niloticus", "Python regius", "Psittacula krameri",
+                 "Ara ararauna"]]
+    return db.build_species_search_index(dropdown)
+
+
+def test_search_keeps_dropdown_ranking():
+    results = db.search_species(species_index_fixture(), "psitt")
+    assert [result["value"] for result in results] == ["Psittacus erithacus", "Psittacula krameri"]
+
+
+def test_search_is_case_insensitive():
+    results = db.search_species(species_index_fixture(), "NILOT")
+    assert [result["value"] for result in results] == ["Crocodylus niloticus"]
+
+
+def test_search_needs_three_characters():
+    index = species_index_fixture()
+    assert db.search_species(index, "ps") == []
+    assert db.search_species(index, "") == []
+    assert len(db.search_species(index, "psi")) == 2
+
+
+def test_search_checks_the_whole_query():
+    # All trigrams of "araus" ("ara", "rau", "aus") are in "Ara ararauna", the query itself is not
+    assert db.search_species(species_index_fixture(), "araus") == []
+
+
+def test_search_limit():
+    results = db.search_species(species_index_fixture(), "us ", limit=1)
+    assert [result["value"] for result in results] == ["Psittacus erithacus"]
+
+
+"""
+Request coalescing
+"""
+
+
+def test_coalesce_computes_once_for_concurrent_callers():
+    calls = []
+    release = threading.Event()
+
+    def compute():
+        calls.append(1)
+        release.wait(5)
+        return "result"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(db.coalesce(("test", "concurrent"), compute, ttl=0)))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == ["result"] * 8
+    assert len(calls) == 1
+
+
+def test_coalesce_keeps_results_for_the_ttl():
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return len(calls)
+
+    assert db.coalesce(("test", "ttl"), compute, ttl=60) == 1
+    assert db.coalesce(("test", "ttl"), compute, ttl=60) == 1
+    assert db.coalesce(("test", "no ttl"), compute, ttl=0) == 2
+    assert db.coalesce(("test", "no ttl"), compute, ttl=0) == 3
+
+
+def test_coalesce_failure_is_not_kept():
+    def fail():
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        db.coalesce(("test", "failure"), fail)
+    assert db.coalesce(("test", "failure"), lambda: "retried") == "retried"
+    assert db.coalesce_info()["pending"] == 0
+
+
+"""
+Imports
+"""
+
+
+def test_database_layer_does_not_load_the_dashboard():
+    # The build script imports database_scripts, it must not pull in plot_builder (import cycle), Plotly or Dash
+    code = "import sys, database_scripts; print([m for m in ('plot_builder', 'plotly', 'dash') if m in sys.modules])"
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, "-c", code], cwd=repo_root, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "[]"
@@ -0,0 +1,50 @@
+import sqlite3
+import database_scripts as db
+import figure_cache as fc
+
+
+def database_fixture(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "cites.db"), isolation_level=None)
+    db.mark_database_build(conn)
+    return conn
+
+
+def test_stored_none_is_a_hit(tmp_path):
+    conn = database_fixture(tmp_path)
+    calls = []
+
+    def build():
+        calls.append(1)
+        return None
+
+    assert fc.cached(conn, "test_none", build, "Taxon") is None
+    assert fc.cached(conn, "test_none", build, "Taxon") is None
+    assert len(calls) == 1
+
+
+def test_hits_do_not_write(tmp_path):
+    conn = database_fixture(tmp_path)
+    fc.cached(conn, "test_hits", lambda: {"value": 1}, "Taxon", 2000, ["b", "a"])
+    cache_conn = fc.figure_cache_connections[fc.figure_cache_path(conn)]
+    changes = cache_conn.total_changes
+    for _ in range(10):
+        # Filter order does not matter
+        assert fc.cached(conn, "test_hits", lambda: None, "Taxon", 2000, ["a", "b"]) == {"value": 1}
+    assert cache_conn.total_changes == changes
+    assert fc.figure_cache_info(conn)["functions"]["test_hits"] == {"hits": 10, "misses": 1,
+                                                                    "hit_rate": 10 / 11}
+
+
+def test_rebuild_invalidates_entries(tmp_path):
+    conn = database_fixture(tmp_path)
+    fc.cached(conn, "test_build", lambda: 1, "Taxon")
+    db.mark_database_build(conn)
+    assert fc.cached(conn, "test_build", lambda: 2, "Taxon") == 2
+    assert fc.figure_cache_info(conn)["entries"] == 1
+
+
+def test_format_change_invalidates_entries(tmp_path, monkeypatch):
+    conn = database_fixture(tmp_path)
+    fc.cached(conn, "test_version", lambda: 1, "Taxon")
+    monkeypatch.setattr(fc, "figure_cache_version", fc.figure_cache_version + 1)
+    assert fc.cached(conn, "test_version", lambda: 2, "Taxon") == 2
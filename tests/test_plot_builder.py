@@ -0,0 +1,121 @@
+import numpy as np
+import pandas as pd
+import plot_builder as pltbld
+
+
+def aggregate_connections_reference(df):
+    # Original row by row aggregation, one row per shipment, sorted by year
+    df2 = df.loc[:, ["Exporter", "Importer"]].drop_duplicates(inplace=False).reset_index(drop=True)
+    df2["count"], df2["width"], df2["opacity"], df2["last_shipment"] = 0, 0.0, 0.0, 0
+    shipment_traces = df2.set_index(["Exporter", "Importer"])
+    shipment_traces.sort_index(level=0, inplace=True)
+    current_year = 0
+    for index, row in df.iterrows():
+        if row["Importer"] != "Unknown" and row["Exporter"] != "Unknown":
+            if current_year != row["Year"]:
+                current_year = row["Year"]
+                shipment_traces["opacity"] = shipment_traces["opacity"].apply(pltbld.opacity_decrease)
+            shipment_traces.loc[(row["Exporter"], row["Importer"]), ["count"]] += 1
+            shipment_traces.loc[(row["Exporter"], row["Importer"]), ["opacity"]] = 1.0
+            shipment_traces.loc[(row["Exporter"], row["Importer"]), ["last_shipment"]] = current_year
+    return shipment_traces
+
+
+def shipments_fixture():
+    # Duplicate pairs in a year, unknown exporters/importers and connections that stop trading
+    return pd.DataFrame([
+        (2000, "DE", "FR", 2),
+        (2000, "DE", "FR", 1),
+        (2000, "Unknown", "FR", 4),
+        (2001, "US", "CA", 1),
+        (2001, "DE", "FR", 1),
+        (2003, "US", "CA", 2),
+        (2003, "DE", "Unknown", 1),
+        (2004, "CN", "US", 3),
+        (2008, "CN", "US", 1),
+        (2009, "BR", "AR", 1),
+        (2010, "BR", "AR", 1),
+        (2012, "BR", "AR", 5),
+    ], columns=["Year", "Exporter", "Importer", "Count"])
+
+
+def test_aggregate_connections_matches_reference():
+    df = shipments_fixture()
+    expected = aggregate_connections_reference(df.loc[df.index.repeat(df["Count"])])
+    pd.testing.assert_frame_equal(pltbld.aggregate_connections(df), expected, check_dtype=False)
+
+
+def test_aggregate_connections_keeps_untraded_connections():
+    df = shipments_fixture()
+    traces = pltbld.aggregate_connections(df)
+    assert traces.loc[("Unknown", "FR"), "count"] == 0
+    assert traces.loc[("DE", "Unknown"), "last_shipment"] == 0
+
+
+def test_spread_midpoints_moves_overlapping_points():
+    mid_latitude, mid_longitude = pltbld.spread_midpoints(np.array([10.0, 10.1, 40.0]), np.array([20.0, 20.1, 5.0]))
+    assert (mid_latitude[0], mid_longitude[0]) == (10.0, 20.0)
+    assert (mid_latitude[1], mid_longitude[1]) != (10.1, 20.1)
+    assert (mid_latitude[2], mid_longitude[2]) == (40.0, 5.0)
+
+
+def test_spread_midpoints_keeps_nan_midpoints():
+    # A country without coordinates (e.g. an unmapped code) gives a NaN midpoint
+    mid_latitude, mid_longitude = pltbld.spread_midpoints(np.array([10.0, np.nan, 10.1, np.nan]),
+                                                          np.array([20.0, np.nan, 20.1, 3.0]))
+    assert np.isnan(mid_latitude[1]) and np.isnan(mid_longitude[1])
+    assert np.isnan(mid_latitude[3]) and mid_longitude[3] == 3.0
+    assert (mid_latitude[0], mid_longitude[0]) == (10.0, 20.0)
+    assert (mid_latitude[2], mid_longitude[2]) != (10.1, 20.1)
+
+
+def timeline_fixture(monkeypatch, extra_connections=0):
+    df = shipments_fixture()
+    # Connections only traded in the first year, so most of the connections keep their count
+    extra = pd.DataFrame([(2000, "E{0}".format(i), "I{0}".format(i), 1) for i in range(extra_connections)],
+                         columns=df.columns)
+    df = pd.concat([df, extra], ignore_index=True)
+    known = df[(df["Importer"] != "Unknown") & (df["Exporter"] != "Unknown")]
+    monkeypatch.setattr(pltbld, "load_connection_shipments", lambda *args: known)
+    return known, pltbld.build_connection_timeline("Taxon", [], [], [], None)
+
+
+def test_connection_store_matches_aggregate_connections(monkeypatch):
+    known, timeline = timeline_fixture(monkeypatch)
+    for year in [2001, 2004, 2012]:
+        columns = pltbld.connection_store_columns(timeline, year)
+        expected = pltbld.aggregate_connections(known[known["Year"] <= year])
+        expected = expected.reindex(pd.MultiIndex.from_frame(timeline["pairs"]))
+        traded = expected["count"].notna().to_numpy()
+        assert columns["count"].tolist() == expected["count"].fillna(0).astype(int).tolist()
+        assert columns["last_shipment"].tolist() == expected["last_shipment"].fillna(0).astype(int).tolist()
+        assert np.allclose(columns["opacity"][traded], expected["opacity"][traded], atol=0.005)
+
+
+def test_connection_store_patch_gives_the_store_of_the_year(monkeypatch):
+    known, timeline = timeline_fixture(monkeypatch, extra_connections=40)
+    monkeypatch.setattr(pltbld, "get_connection_timeline", lambda *args: timeline)
+    store = {column: values.tolist() for column, values in pltbld.connection_store_columns(timeline, 2003).items()}
+    patch = pltbld.connection_store_patch("Taxon", 2003, 2004, [], [], [], None)
+    # Count and last shipment only change for the connection traded in 2004, the opacity for all others
+    traded = pd.MultiIndex.from_frame(timeline["pairs"]).get_loc(("CN", "US"))
+    assert {tuple(operation["location"]) for operation in patch.to_plotly_json()["operations"]} == {
+        ("count", traded), ("last_shipment", traded), ("opacity",)}
+    for operation in patch.to_plotly_json()["operations"]:
+        location = operation["location"]
+        if len(location) == 1:
+            store[location[0]] = operation["params"]["value"]
+        else:
+            store[location[0]][location[1]] = operation["params"]["value"]
+    expected = pltbld.connection_store_columns(timeline, 2004)
+    assert store == {column: values.tolist() for column, values in expected.items()}
+
+
+def test_connection_timeline_memo_ignores_filter_order(monkeypatch):
+    builds = []
+    monkeypatch.setattr(pltbld.db, "get_database_build_id", lambda conn: "build")
+    monkeypatch.setattr(pltbld, "build_connection_timeline", lambda *args: builds.append(args) or len(builds))
+    monkeypatch.setattr(pltbld, "connection_timelines", pltbld.create_memo(16))
+    first = pltbld.get_connection_timeline("Taxon", ["live", "skins"], ["T", None], ["W", "C"], None)
+    assert pltbld.get_connection_timeline("Taxon", ["skins", "live"], [None, "T"], ["C", "W"], None) == first
+    assert len(builds) == 1
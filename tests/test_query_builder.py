@@ -0,0 +1,35 @@
+import json
+import sqlite3
+import query_builder as qb
+
+
+def test_in_lists_are_one_json_parameter():
+    sql, params = qb.select("shipments", ["Year", "Count"], equals={"Taxon": "Panthera leo"},
+                            in_lists={"Term": ["live", "skins"], "Source": ["W"]})
+    assert sql == "SELECT Year, Count FROM shipments WHERE \"Taxon\"=? AND " \
+                  "\"Term\" IN (SELECT value FROM json_each(?)) AND \"Source\" IN (SELECT value FROM json_each(?))"
+    assert params == ["Panthera leo", json.dumps(["live", "skins"]), json.dumps(["W"])]
+
+
+def test_sql_text_does_not_depend_on_list_length():
+    short_sql, _ = qb.select("shipments", in_lists={"Term": ["live"]})
+    long_sql, _ = qb.select("shipments", in_lists={"Term": ["live", "skins", "eggs", "bodies"]})
+    assert short_sql == long_sql
+
+
+def test_none_is_left_out_of_in_lists():
+    _, params = qb.select("shipments", in_lists={"Purpose": ["T", None, "Z"]})
+    assert params == [json.dumps(["T", "Z"])]
+
+
+def test_group_by_and_order_by():
+    sql, _ = qb.select("shipments", ["Year", "SUM(Count)"], group_by=["Year"], order_by=["Year"])
+    assert sql == "SELECT Year, SUM(Count) FROM shipments GROUP BY Year ORDER BY \"Year\""
+
+
+def test_in_list_filters_rows():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE shipments (Taxon TEXT, Term TEXT)")
+    conn.executemany("INSERT INTO shipments VALUES (?, ?)", [("a", "live"), ("a", "skins"), ("a", "eggs")])
+    sql, params = qb.select("shipments", ["Term"], in_lists={"Term": ["live", "eggs"]}, order_by=["Term"])
+    assert [row[0] for row in conn.execute(sql, params)] == ["eggs", "live"]
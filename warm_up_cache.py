@@ -0,0 +1,8 @@
+import sys
+import plot_builder as pltbld
+
+if __name__ == "__main__":
+    # Usage: python warm_up_cache.py [number of taxa]
+    # The guard is needed for the worker processes
+    top_n = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    pltbld.warm_up_caches("cites", top_n)